@@ -21,20 +21,30 @@
  ***************************************************************************/
 """
 
+import collections
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
 import ctypes
 import datetime
-import numpy as np
+import hashlib
+import multiprocessing
 import os
-from osgeo import gdal, osr
+from osgeo import gdal
 import pandas as pd
 import PyQt5.QtCore as QTC
 import PyQt5.QtWidgets as QTW 
 import qgis.core 
 from qgis.PyQt import QtWidgets, uic
-import requests
+import shutil
+import subprocess
+import sys
+import tempfile
 import time
 import webbrowser
 
+from .FAO_Downloader_http import CatalogCache, DownloadEngine, get_session, JobPoller
+from .FAO_Downloader_query import Catalog, index_members, parse_avail_items, raster_tasks, remove_duplicate_cells
+from .FAO_Downloader_raster import clear_masks, DataCube, datacube_available, load_profile, output_profile, period_start, prepare_cutline, process_raster, RunManifest, save_profile, TimeStack
 
 
 
@@ -42,6 +52,35 @@ import webbrowser
 
 
 
+
+class TaskThread(QTC.QThread):
+    #Runs a function away from the GUI thread and hands its result back through a signal,
+    #so network calls made by the dialog do not freeze QGIS.
+    Finished = QTC.pyqtSignal(object)
+    Failed = QTC.pyqtSignal(str)
+
+    def __init__(self, function):
+        super().__init__()
+        self.function = function
+
+
+    def run(self):
+        try:
+            result = self.function()
+        except Exception as e:
+            self.Failed.emit(str(e))
+            return
+        self.Finished.emit(result)
+
+
+
+
+#output format of the rasters, written by the dialog and read by runs without the dialog
+PROFILE_FILE = os.path.join(os.path.dirname(__file__), 'output_profile.json')
+OUTPUT_FORMATS = {'GeoTIFF': 'GTiff', 'Cloud Optimized GeoTIFF': 'COG'}
+STACK_FORMATS = {'None': 'NONE', 'VRT': 'VRT', 'Multi-band GeoTIFF': 'GTiff'}
+
+
 # This loads your .ui file so that PyQt can populate your plugin with the elements from Qt Designer
 FORM_CLASS, _ = uic.loadUiType(os.path.join(
      os.path.dirname(__file__), 'FAO_Downloader_dialog_base.ui'))
@@ -62,6 +101,12 @@ class FAODownloaderDialog(QtWidgets.QDialog, FORM_CLASS):
         self.path_sign_in=r'https://io.apps.fao.org/gismgr/api/v1/iam/sign-in/'
         
         self.workspaces='WAPOR_2'
+        self.session = get_session()
+        self.catalog_cache = CatalogCache()
+        self.url_workspaces = r'https://io.apps.fao.org/gismgr/api/v1/catalog/workspaces?overview=true&paged=false'
+        #background tasks that are still running, kept here so they are not garbage collected
+        self.tasks = []
+        self.MasterList = Catalog()
 
         self.token_is_valid = False
 
@@ -117,14 +162,11 @@ class FAODownloaderDialog(QtWidgets.QDialog, FORM_CLASS):
         self.wapor_tokenbox.setPlaceholderText("Paste your new token here")
 
         # set default variable states
+        # the token is checked in the background, token_checked switches to the settings when it is not valid
+        self.tab_pages.setCurrentIndex(0)
         self.validate_token()
         self.check_default_download_dir()
 
-        if self.token_is_valid:
-            self.tab_pages.setCurrentIndex(0)
-        else:
-            self.tab_pages.setCurrentIndex(2)
-
         default_dir_fn = os.path.join(os.path.dirname(__file__), 'defdir.dll')
         if self.exists(default_dir_fn):
             dld_location = self.read_from(default_dir_fn)[0]
@@ -136,8 +178,10 @@ class FAODownloaderDialog(QtWidgets.QDialog, FORM_CLASS):
             self.txb_download_location.setText("")
             self.current_download_location = None
 
+        self.show_output_profile(load_profile(PROFILE_FILE))
+
         self.treeWidget.clear()
-        self.treeWidget.headerItem().setText(0, '')
+        self.treeWidget.headerItem().setText(0, 'Loading catalog...')
        
         # load catalog to treewidgit
         self.load_catalog()
@@ -145,26 +189,104 @@ class FAODownloaderDialog(QtWidgets.QDialog, FORM_CLASS):
         self.mMapLayerComboBox.setFilters(qgis.core.QgsMapLayerProxyModel.PolygonLayer)
         
 
+    def run_task(self, function, on_done, on_error = None):
+        #Starts function on a TaskThread, on_done receives its result on the GUI thread.
+        task = TaskThread(function)
+        task.Finished.connect(on_done)
+        if on_error != None:
+            task.Failed.connect(on_error)
+        else:
+            task.Failed.connect(self.task_failed)
+        task.finished.connect(lambda: self.tasks.remove(task))
+        self.tasks.append(task)
+        task.start()
+
+
+    def task_failed(self, message):
+        print('Error', 'Could not connect to server.', message)
+
+
     def pop_workspace(self):
-        workspaces = requests.get("https://io.apps.fao.org/gismgr/api/v1/catalog/workspaces?overview=true&paged=false").json().get('response')
+        #The workspaces known from the last session are listed straight away,
+        #the list is refreshed from the server in the background when it is out of date.
+        entry = self.catalog_cache.cached(self.url_workspaces)
+        if entry != None:
+            self.fill_workspaces(entry['json'])
+            if self.catalog_cache.is_fresh(entry):
+                return
+        else:
+            self.cbx_workspace.blockSignals(True)
+            self.cbx_workspace.addItem("WAPOR_2")
+            self.cbx_workspace.blockSignals(False)
+        self.run_task(lambda: self.catalog_cache.revalidate(self.url_workspaces, entry), self.workspaces_refreshed)
+
+
+    def workspaces_refreshed(self, result):
+        data, changed = result
+        if changed:
+            self.fill_workspaces(data)
+
+
+    def fill_workspaces(self, data):
+        workspaces = data.get('response')
+        current = self.cbx_workspace.currentText() or "WAPOR_2"
+        #signals are blocked so filling the combo does not load the catalog of every workspace on the way
+        self.cbx_workspace.blockSignals(True)
+        self.cbx_workspace.clear()
         for workspace in workspaces:
             self.cbx_workspace.addItem(workspace['code'])
-        self.cbx_workspace.setCurrentText("WAPOR_2")    
+        self.cbx_workspace.setCurrentText(current)    
+        self.cbx_workspace.blockSignals(False)
+        if self.cbx_workspace.currentText() != current:
+            self.load_catalog()
         
 
+    def catalog_urls(self, workspace):
+        if workspace == 'WAPOR_2':
+            #Cubes: provides operations pertaining to Cube resources
+            #returns a list of available Cube resource type items
+            #example:https://io.apps.fao.org/gismgr/api/v1/catalog/workspaces/WAPOR_2/cubes?overview=false&paged=false&sort=sort%20%3D%20code&tags=L1'
+            return ['{0}{1}/cubes?overview=false&paged=false&sort=sort%20%3D%20code&tags={2}'.format(self.path_catalog, workspace, tag) for tag in ['L1', 'L2', 'L3']]
+        return ['{0}{1}/cubes?overview=false&paged=false'.format(self.path_catalog, workspace)]
+
+
     def load_catalog(self):
         print('loading catalog...')
-        
-        
-        if self.cbx_workspace.currentText() == 'WAPOR_2':
+        workspace = self.cbx_workspace.currentText()
+        urls = self.catalog_urls(workspace)
+
+        #The copy on disk is shown straight away. The server is only asked when that copy
+        #is older than the cache TTL, and the tree is only rebuilt when the server copy changed.
+        cached = [self.catalog_cache.cached(url) for url in urls]
+        shown = all(entry != None for entry in cached)
+        if shown:
+            self.show_catalog(workspace, [entry['json'].get('response') for entry in cached])
+            if all(self.catalog_cache.is_fresh(entry) for entry in cached):
+                return
+        #the L1/L2/L3 lists of WAPOR_2 are requested at the same time, away from the GUI thread
+        self.run_task(lambda: self.catalog_cache.revalidate_all(urls, cached),
+                      lambda results: self.catalog_refreshed(workspace, shown, results),
+                      lambda message: self.catalog_failed(workspace, shown, message))
+
+
+    def catalog_refreshed(self, workspace, shown, results):
+        #the user may have picked another workspace while this one was loading
+        if workspace != self.cbx_workspace.currentText():
+            return
+        if not shown or any(changed for data, changed in results):
+            self.show_catalog(workspace, [data.get('response') for data, changed in results])
+
+
+    def catalog_failed(self, workspace, shown, message):
+        print('Could not refresh the catalog: {0}'.format(message))
+        if not shown and workspace == self.cbx_workspace.currentText():
+            self.treeWidget.headerItem().setText(0, 'Could not reach the FAO server')
+
+
+    def show_catalog(self, workspace, responses):
+        if workspace == 'WAPOR_2':
             try:
-                #Cubes: provides operations pertaining to Cube resources
-                #returns a list of available Cube resource type items
-                #example:https://io.apps.fao.org/gismgr/api/v1/catalog/workspaces/WAPOR_2/cubes?overview=false&paged=false&sort=sort%20%3D%20code&tags=L1'
-                L1 = ((requests.get('{0}{1}/cubes?overview=false&paged=false&sort=sort%20%3D%20code&tags=L1'.format(self.path_catalog,self.workspaces)).json()).get('response'))
-                L2 = ((requests.get('{0}{1}/cubes?overview=false&paged=false&sort=sort%20%3D%20code&tags=L2'.format(self.path_catalog,self.workspaces)).json()).get('response'))
-                L3 = ((requests.get('{0}{1}/cubes?overview=false&paged=false&sort=sort%20%3D%20code&tags=L3'.format(self.path_catalog,self.workspaces)).json()).get('response'))            
-                
+                L1, L2, L3 = responses
                 
                 #sorts by type of information
                 L1 = sorted(L1, key=lambda d: d.get('caption'))
@@ -173,12 +295,11 @@ class FAODownloaderDialog(QtWidgets.QDialog, FORM_CLASS):
                 #Sorts first country location, then by type of information
                 L3 = sorted(L3, key=lambda d: [d.get('additionalInfo', {}).get('spatialExtent').partition(", ")[2],d.get('additionalInfo', {}).get('spatialExtent').partition(", ")[1] ,d.get('code') ])
                 
-                self.MasterList = L1 + L2 + L3
-                level_list = [L1, L2, L3] 
+                self.MasterList = Catalog([('L1', L1), ('L2', L2), ('L3', L3)])
                 #creates the treewidget to select data from
                 self.treeWidget.clear()
                 self.treeWidget.headerItem().setText(0, self.workspaces)
-                self.TreeWaPOR(level_list, "WAPOR_2")
+                self.TreeWaPOR(self.MasterList, "WAPOR_2")
                 
                 self.combo_dekadal.show()
                 self.label_dekadal.show()
@@ -188,12 +309,12 @@ class FAODownloaderDialog(QtWidgets.QDialog, FORM_CLASS):
         
         else:
             try:
-                L = ((requests.get('{0}{1}/cubes?overview=false&paged=false'.format(self.path_catalog,self.cbx_workspace.currentText())).json()).get('response'))
+                L = responses[0]
                 L = sorted(L, key=lambda d: d.get('caption'))
-                self.MasterList = L
+                self.MasterList = Catalog([(None, L)])
                 self.treeWidget.clear()
-                self.treeWidget.headerItem().setText(0, self.cbx_workspace.currentText())
-                self.TreeAddBasic(L, self.cbx_workspace.currentText())    
+                self.treeWidget.headerItem().setText(0, workspace)
+                self.TreeAddBasic(L, workspace)    
                 
                 self.combo_dekadal.hide()
                 self.label_dekadal.hide()
@@ -215,14 +336,13 @@ class FAODownloaderDialog(QtWidgets.QDialog, FORM_CLASS):
             child.setCheckState(0, QTC.Qt.CheckState.Unchecked)
             
             
-    def TreeWaPOR(self, level_list, name):    
+    def TreeWaPOR(self, catalog, name):    
         parent = QTW.QTreeWidgetItem(self.treeWidget)
         parent.setText(0, name)
         parent.setFlags(parent.flags() |  QTC.Qt.ItemFlag.ItemIsUserCheckable | QTC.Qt.ItemFlag.ItemIsAutoTristate)
         Levels = ['Level 1 (250m)', 'Level 2 (100m)', 'Level 3 (30m)']
-        locations = []
         index = 0
-        for L in level_list:        
+        for tag in ['L1', 'L2', 'L3']:        
             level = QTW.QTreeWidgetItem(parent)
             level.setFlags(level.flags() | QTC.Qt.ItemFlag.ItemIsUserCheckable| QTC.Qt.ItemFlag.ItemIsAutoTristate)
             level.setText(0, Levels[index])
@@ -230,28 +350,28 @@ class FAODownloaderDialog(QtWidgets.QDialog, FORM_CLASS):
                        
             
             
-            if L != level_list[2]:
-                for x in L:
+            if tag != 'L3':
+                for x in catalog.level(tag):
                     child = QTW.QTreeWidgetItem(level)
                     child.setFlags(child.flags() | QTC.Qt.ItemFlag.ItemIsUserCheckable)
                     child.setText(0, x.get('caption'))
                     child.setText(1, str(x.get('code')))
                     child.setCheckState(0, QTC.Qt.CheckState.Unchecked)
    
-            if L == level_list[2]:
-                for x in L:
-                    if (x.get('additionalInfo').get('spatialExtent')) not in locations:
-                        locations.append(x.get('additionalInfo').get('spatialExtent'))
-                        country = QTW.QTreeWidgetItem(level)
-                        country.setFlags(country.flags() | QTC.Qt.ItemFlag.ItemIsUserCheckable| QTC.Qt.ItemFlag.ItemIsAutoTristate)
-                        country.setText(0, locations[-1])
-                        country.setCheckState(0, QTC.Qt.CheckState.Unchecked)        
+            if tag == 'L3':
+                #one item per location, the catalog already grouped the cubes by spatialExtent
+                for location, cubes in catalog.by_extent(tag).items():
+                    country = QTW.QTreeWidgetItem(level)
+                    country.setFlags(country.flags() | QTC.Qt.ItemFlag.ItemIsUserCheckable| QTC.Qt.ItemFlag.ItemIsAutoTristate)
+                    country.setText(0, location)
+                    country.setCheckState(0, QTC.Qt.CheckState.Unchecked)        
         
-                    child2 = QTW.QTreeWidgetItem(country)
-                    child2.setFlags(child2.flags() | QTC.Qt.ItemFlag.ItemIsUserCheckable)
-                    child2.setText(0, x.get('caption'))
-                    child2.setCheckState(0, QTC.Qt.CheckState.Unchecked)     
-                    child2.setText(1, str(x.get('code')))              
+                    for x in cubes:
+                        child2 = QTW.QTreeWidgetItem(country)
+                        child2.setFlags(child2.flags() | QTC.Qt.ItemFlag.ItemIsUserCheckable)
+                        child2.setText(0, x.get('caption'))
+                        child2.setCheckState(0, QTC.Qt.CheckState.Unchecked)     
+                        child2.setText(1, str(x.get('code')))              
             index += 1
 
             
@@ -278,9 +398,17 @@ class FAODownloaderDialog(QtWidgets.QDialog, FORM_CLASS):
         bbox = self.get_bbox()
         token = self.read_token()
         
+        profile = self.selected_output_profile()
+        save_profile(PROFILE_FILE, profile)
+        
         self.worker = WorkerThread(token, bbox, 
                                    self.current_download_location, self.chb_clip_to_cutline.isChecked(), self.combo_dekadal.currentText(),
-                                   self.treeWidget, start_date, end_date, self.MasterList, vector_location, self.cbx_workspace.currentText())
+                                   self.treeWidget, start_date, end_date, self.MasterList, vector_location, self.cbx_workspace.currentText(),
+                                   MaxJobs = self.spb_max_jobs.value(), MaxDownloads = self.spb_max_downloads.value(),
+                                   MaxPerHost = self.spb_max_per_host.value(), JobTimeout = self.spb_job_timeout.value() * 60,
+                                   Resume = self.chb_resume.isChecked(), MemoryBudget = self.spb_memory_budget.value(),
+                                   FusedClip = self.chb_fused_clip.isChecked(), OutputProfile = profile,
+                                   MaxProcesses = self.spb_max_processes.value(), SimplifyCutline = self.chb_simplify_cutline.isChecked())
         self.worker.start()
         self.worker.UpdateStatus.connect(self.evt_UpdateStatusUI)
         self.worker.UpdateProgress.connect(self.UpdateProgressUI)
@@ -301,6 +429,33 @@ class FAODownloaderDialog(QtWidgets.QDialog, FORM_CLASS):
             self.pbar_secondary.setValue(0)
             
         
+    def show_output_profile(self, profile):
+        for text, driver in OUTPUT_FORMATS.items():
+            if driver == profile['format']:
+                self.cbx_output_format.setCurrentText(text)
+        compress = profile['compress'].upper()
+        self.cbx_compression.setCurrentText('None' if compress == 'NONE' else compress)
+        self.chb_predictor.setChecked(profile['predictor'])
+        self.chb_tiled.setChecked(profile['tiled'])
+        self.chb_overviews.setChecked(profile['overviews'])
+        self.chb_native_dtype.setChecked(profile['native_dtype'])
+        for text, kind in STACK_FORMATS.items():
+            if kind == profile['stack']:
+                self.cbx_stack.setCurrentText(text)
+        self.cbx_datacube.setCurrentText('None' if profile['datacube'] == 'NONE' else profile['datacube'])
+
+
+    def selected_output_profile(self):
+        return output_profile(format = OUTPUT_FORMATS[self.cbx_output_format.currentText()],
+                              compress = self.cbx_compression.currentText().upper(),
+                              predictor = self.chb_predictor.isChecked(),
+                              tiled = self.chb_tiled.isChecked(),
+                              overviews = self.chb_overviews.isChecked(),
+                              native_dtype = self.chb_native_dtype.isChecked(),
+                              stack = STACK_FORMATS[self.cbx_stack.currentText()],
+                              datacube = self.cbx_datacube.currentText().replace('None', 'NONE'))
+
+        
     def evt_UpdateStatusUI(self, text):
         if text == "Status: Download Completed":
             if self.btn_download.text() == "Cancel Download":
@@ -318,7 +473,7 @@ class FAODownloaderDialog(QtWidgets.QDialog, FORM_CLASS):
     
     def UpdateProgressUI(self, text):
 
-        if len(text.split("\n")) == 3:
+        if len(text.split("\n")) >= 3:
             try:
                 # update progress bar
                 base_parts = text.split("\n"); cpp = base_parts[1].split(' '); spp = base_parts[2].split(' ')
@@ -367,10 +522,17 @@ class FAODownloaderDialog(QtWidgets.QDialog, FORM_CLASS):
 
 
     def validate_token(self):
-        resp_vp=requests.post(self.path_sign_in,headers={'X-GISMGR-API-KEY':self.read_token()})
-        resp_vp = resp_vp.json()
+        #signs in on a background task, token_checked handles the answer
+        self.lbl_token_status.setText("Checking Token...")
+        token = self.read_token()
+        self.run_task(lambda: self.session.post(self.path_sign_in,headers={'X-GISMGR-API-KEY':token}).json(),
+                      self.token_checked, self.token_check_failed)
+
+
+    def token_checked(self, resp_vp):
         print("validate_token")
         print(resp_vp)
+        self.token_is_valid = False
         try:
             if resp_vp['message'] == "OK":
                 self.token_is_valid = True
@@ -378,10 +540,18 @@ class FAODownloaderDialog(QtWidgets.QDialog, FORM_CLASS):
                 self.AccessToken = resp_vp['response']['accessToken']
                 self.time_expire = resp_vp['response']['expiresIn']
                 self.time_start = datetime.datetime.now().timestamp()
+            else:
+                self.lbl_token_status.setText("Can't Validate Token")
 
         except:
             self.lbl_token_status.setText("Can't Validate Token")
             print( 'Error','Could not connect to server.',0)  
+        if not self.token_is_valid:
+            self.tab_pages.setCurrentIndex(2)
+
+
+    def token_check_failed(self, message):
+        self.token_checked({'message': message})
 
 
     def browse_default_directory(self):
@@ -447,7 +617,7 @@ class FAODownloaderDialog(QtWidgets.QDialog, FORM_CLASS):
     def LaunchPopup(self, item):
         if item.childCount()  == 0 or item.parent() == None:
             if item.childCount()  == 0 and item.parent() != None:
-                self.pop = InfoPopup(item.text(1), 0, self.MasterList)
+                self.pop = InfoPopup(item.text(1), 0, self.MasterList, self.cbx_workspace.currentText())
             if item.parent() == None:
                 self.pop = InfoPopup(item.text(0),1)
             self.pop.setWindowTitle(item.text(0))
@@ -455,15 +625,27 @@ class FAODownloaderDialog(QtWidgets.QDialog, FORM_CLASS):
 
 
 class InfoPopup(QTW.QWidget):
-        def __init__(self, code, index, MasterList = None):
+        def __init__(self, code, index, MasterList = None, workspace = None):
             super().__init__()
+            catalog_cache = CatalogCache()
             layout = QTW.QGridLayout()
             if index == 0:
-                for x in MasterList:
-                    if str(x.get('code'))  == code:                 
+                x = MasterList.get(code)
+                if x != None:                 
                       keylist = ['caption', 'code', 'description']+list(x.get('additionalInfo').keys())
                       valuelist = [x.get('caption'), x.get('code'), x.get('description')]+list(x.get('additionalInfo').values())
                       
+                      #measure and dimensions are shown when an earlier download already stored them in the cache
+                      measures = catalog_cache.cached(r'https://io.apps.fao.org/gismgr/api/v1/catalog/workspaces/{0}/cubes/{1}/measures?overview=false&paged=false'.format(workspace, code))
+                      if measures != None and measures['json'].get('response'):
+                          measure = measures['json']['response'][0]
+                          keylist += ['measure', 'unit', 'multiplier']
+                          valuelist += [measure.get('caption'), measure.get('unit'), measure.get('multiplier')]
+                      dimensions = catalog_cache.cached(r'https://io.apps.fao.org/gismgr/api/v1/catalog/workspaces/{0}/cubes/{1}/dimensions?overview=false&paged=false'.format(workspace, code))
+                      if dimensions != None and dimensions['json'].get('response'):
+                          keylist.append('dimensions')
+                          valuelist.append(', '.join(str(d.get('caption')) for d in dimensions['json']['response']))
+                      
                       keyitems = len(keylist)-1
                       keyposition = 0
                       while keyposition <= keyitems:
@@ -480,9 +662,8 @@ class InfoPopup(QTW.QWidget):
                               layout.addWidget(y,keyposition,1)
                               
                               keyposition += 1
-                      break         
             if index == 1:
-                      responce = ((requests.get(r'https://io.apps.fao.org/gismgr/api/v1/catalog/workspaces/{0}'.format(code)).json()).get('response'))
+                      responce = ((catalog_cache.get(r'https://io.apps.fao.org/gismgr/api/v1/catalog/workspaces/{0}'.format(code))).get('response'))
                       print(responce)
                       keylist = []
                       valuelist = []
@@ -527,7 +708,7 @@ class WorkerThread(QTC.QThread):
     UpdateStatus = QTC.pyqtSignal(str)
     UpdateProgress = QTC.pyqtSignal(str)
     
-    def __init__(self, wapor_api_token, bbox, FolderLocation, CropChecked, Combo, SelectWidget, Startdate, Enddate, MasterList, vector_location, workspace):
+    def __init__(self, wapor_api_token, bbox, FolderLocation, CropChecked, Combo, SelectWidget, Startdate, Enddate, MasterList, vector_location, workspace, MaxJobs = 8, MaxDownloads = 4, MaxPerHost = 4, JobTimeout = 3600, Resume = False, MemoryBudget = 256, FusedClip = True, OutputProfile = None, MaxProcesses = 4, SimplifyCutline = False):
         super().__init__()
         self.wapor_api_token = wapor_api_token 
         self.bbox = bbox 
@@ -546,6 +727,35 @@ class WorkerThread(QTC.QThread):
         self.path_query = r'https://io.apps.fao.org/gismgr/api/v1/query/'
         self.path_sign_in = r'https://io.apps.fao.org/gismgr/api/v1/iam/sign-in/'
         self.workspaces = workspace
+        self.session = get_session()
+        self.catalog_cache = CatalogCache()
+        #number of CropRaster jobs that are allowed to run on the FAO server at the same time
+        self.max_jobs = MaxJobs
+        self.poll_interval = 2
+        #seconds after which a job that is still not finished on the server is given up on
+        self.job_timeout = JobTimeout
+        #when True FolderLocation is the folder of an earlier run that is continued
+        self.Resume = Resume
+        #number of processes correcting and clipping rasters, 1 does it on the worker thread itself
+        self.max_processes = MaxProcesses
+        #seconds a candidate python (see PoolPython) and the new process pool get to answer
+        self.pool_timeout = 30
+        #the cutline is prepared once per raster CRS (see PreparedCutline), optionally simplified to half a pixel
+        self.SimplifyCutline = SimplifyCutline
+        self.cutlines = dict()
+        #MB of memory a raster correction may use (in each process), larger rasters are processed in windows
+        self.memory_budget = MemoryBudget * 1024 * 1024
+        #scale and clip each raster in one pass (clip_prepared, or gdal.Warp through a scaling VRT)
+        #instead of correcting it first and clipping the result with gdal.Warp
+        self.FusedClip = FusedClip
+        #format, compression, tiling and overviews of the saved rasters, see FAO_Downloader_raster.output_profile
+        self.profile = OutputProfile if OutputProfile != None else load_profile(PROFILE_FILE)
+        #TimeStack and DataCube of each cube that is being downloaded, when the profile asks for them
+        self.stacks = dict()
+        self.datacubes = dict()
+        #number of rasters that are transferred at the same time, and how many of those may share one server
+        self.max_downloads = MaxDownloads
+        self.max_per_host = MaxPerHost
     
     
     def Mbox(self, title, text, style):
@@ -555,14 +765,26 @@ class WorkerThread(QTC.QThread):
     def run(self):
         x = 0
         self.UpdateStatus.emit("Status: Checking Inputs")
-        #try to make new base folder
-        try:
-            self.base_save_folder = os.path.join(self.FolderLocation,self.workspaces + " " + datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S"))
-            print(self.base_save_folder)
-            os.makedirs(self.base_save_folder)
-        except:
-            self.Mbox('Error', 'Unable to create new folder for download in the selected folder.', 0)
-            x += 1    
+        if self.Resume:
+            #continue the run that was downloaded into the selected folder
+            self.base_save_folder = self.FolderLocation
+            if self.FolderLocation == None or not os.path.isfile(os.path.join(self.base_save_folder, RunManifest.FILENAME)):
+                self.Mbox('Error', 'The selected folder does not contain an earlier download that can be resumed.', 0)
+                x += 1
+        else:
+            #try to make new base folder
+            try:
+                self.base_save_folder = os.path.join(self.FolderLocation,self.workspaces + " " + datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S"))
+                print(self.base_save_folder)
+                os.makedirs(self.base_save_folder)
+            except:
+                self.Mbox('Error', 'Unable to create new folder for download in the selected folder.', 0)
+                x += 1    
+        if x == 0:
+            self.manifest = RunManifest(self.base_save_folder)
+        if self.profile['datacube'] != 'NONE' and not datacube_available(self.profile['datacube']):
+            self.Mbox('Error', 'The {0} package is not installed, the download continues without datacubes.'.format('netCDF4' if self.profile['datacube'] == 'NetCDF' else 'zarr'), 0)
+            self.profile = dict(self.profile, datacube = 'NONE')
         #check start date is less that end date
         if self.Enddate < self.Startdate:
             self.Mbox('Error', 'End date is earlier than the Start date.', 0)
@@ -584,7 +806,7 @@ class WorkerThread(QTC.QThread):
 
   
     def query_accessToken(self):
-            resp_vp = requests.post(self.path_sign_in,headers = {'X-GISMGR-API-KEY':self.wapor_api_token})
+            resp_vp = self.session.post(self.path_sign_in,headers = {'X-GISMGR-API-KEY':self.wapor_api_token})
             resp_vp = resp_vp.json()
             print("query_accessToken")
             print(resp_vp)
@@ -624,26 +846,31 @@ class WorkerThread(QTC.QThread):
     def AddCubeData(self):
         self.cubedict = dict()
 
+        #Measures
+        #provides operations pertaining to Measure resources
+        #returns a list (paged or not) of available Measure resource type items
+        #example: https://io.apps.fao.org/gismgr/api/v1/catalog/workspaces/WAPOR_2/cubes/L1_E_A/measures?overview=false&paged=false
+        #Cube Dimensions: provides operations pertaining to CubeDimension resources
+        #get the CubeDimensions list
+        #example:https://io.apps.fao.org/gismgr/api/v1/catalog/workspaces/WAPOR_2/cubes/L1_AETI_M/dimensions?overview=false&paged=false
+        #Both are kept in the catalog cache, so cubes used in an earlier run need no request at all,
+        #and the requests for the other cubes are sent at the same time.
+        urls = []
         for cubecode in self.SelectedCubeCodes:
-                    for x in self.MasterList:
-                        if x.get('code')  == cubecode:
-                            self.cubedict[cubecode] = x
-                            break
+            urls.append(r'{0}{1}/cubes/{2}/measures?overview=false&paged=false'.format(self.path_catalog,self.workspaces, cubecode))
+            urls.append(r'{0}{1}/cubes/{2}/dimensions?overview=false&paged=false'.format(self.path_catalog,self.workspaces,cubecode))
+        responses = self.catalog_cache.get_all(urls)
+
+        for i, cubecode in enumerate(self.SelectedCubeCodes):
+                    self.cubedict[cubecode] = dict(self.MasterList.get(cubecode, {}))
                     
-                    #Measures
-                    #provides operations pertaining to Measure resources
-                    #returns a list (paged or not) of available Measure resource type items
-                    #example: https://io.apps.fao.org/gismgr/api/v1/catalog/workspaces/WAPOR_2/cubes/L1_E_A/measures?overview=false&paged=false
-                    request_json = (requests.get(r'{0}{1}/cubes/{2}/measures?overview=false&paged=false'.format(self.path_catalog,self.workspaces, cubecode)).json())
+                    request_json = responses[2 * i]
                     if request_json['status']  == 200:
                         self.cubedict[cubecode].update({'cubemeasure':(request_json['response'][0])})
                     else:
                         self.Mbox( 'Error' ,str(request_json['message']),0)
 
-                    #Cube Dimensions: provides operations pertaining to CubeDimension resources
-                    #get the CubeDimensions list
-                    #example:https://io.apps.fao.org/gismgr/api/v1/catalog/workspaces/WAPOR_2/cubes/L1_AETI_M/dimensions?overview=false&paged=false
-                    request_json = (requests.get(r'{0}{1}/cubes/{2}/dimensions?overview=false&paged=false'.format(self.path_catalog,self.workspaces,cubecode)).json())
+                    request_json = responses[2 * i + 1]
                     if request_json['status']  == 200:
                         self.cubedict[cubecode].update({'cubedimensions':(request_json['response'])})
                     else:
@@ -655,6 +882,106 @@ class WorkerThread(QTC.QThread):
             self.UpdateStatus.emit("Status: Preparing Download")
             m = 0
             self.query_accessToken()
+            self.engine = DownloadEngine(self.max_downloads, self.max_per_host)
+            self.poller = JobPoller(self._check_jobOutput, deadline = self.job_timeout)
+            #Raw downloads are kept on the local disk, only the finished rasters are written to the
+            #download folder (which may be a network share). The folder name only depends on the run
+            #folder, so a resumed run finds the rasters that were already downloaded.
+            self.temp_folder = os.path.join(tempfile.gettempdir(), 'FAO_Downloader',
+                                            hashlib.sha1(os.path.abspath(self.base_save_folder).encode('utf-8')).hexdigest()[:16])
+            self.post_pool = self.StartProcessPool()
+            #the rasterized cutlines of an earlier run in this process may belong to another layer
+            clear_masks()
+            try:
+                self.DownloadCubes(m)
+            finally:
+                self.manifest.flush()
+                self.poller.shutdown()
+                self.engine.shutdown(cancel = self.isInterruptionRequested())
+                #shutdown(cancel_futures = True) needs Python 3.9, PipelineRequest cancels the queued rasters itself.
+                #On cancel the rasters still being processed are not waited for, they keep their 'downloaded' state.
+                if self.post_pool != None:
+                    self.post_pool.shutdown(wait = not self.isInterruptionRequested())
+                            
+            if self.isInterruptionRequested()  == False:
+                shutil.rmtree(self.temp_folder, ignore_errors = True)
+                self.UpdateStatus.emit("Status: Download Completed")
+                self.UpdateProgress.emit("")
+            else:
+                self.UpdateStatus.emit("Status: Download Canceled")
+                self.UpdateProgress.emit("")
+
+
+    def StartProcessPool(self):
+        #Correction and clipping are CPU work, in a process pool they use more than one core and
+        #do not hold up the downloads. Processes are spawned, forking a process with Qt threads is not safe.
+        #Inside QGIS sys.executable can be the QGIS program, which the spawned processes would start
+        #instead of python, so they are started with the python found by PoolPython. Without one, or when
+        #the pool does not answer a first task in time, the rasters are processed on the worker thread.
+        if self.max_processes <= 1:
+            return None
+        python = self.PoolPython()
+        if python == None:
+            print('Rasters are processed on the worker thread, no python interpreter found for the process pool')
+            return None
+        pool = None
+        try:
+            context = multiprocessing.get_context('spawn')
+            context.set_executable(python)
+            pool = concurrent.futures.ProcessPoolExecutor(self.max_processes, mp_context = context)
+            pool.submit(os.getpid).result(timeout = self.pool_timeout)
+            return pool
+        except Exception as e:
+            print('Rasters are processed on the worker thread, the process pool did not start: {0!r}'.format(e))
+            if pool != None:
+                #processes that hang on start up would keep shutdown waiting, so they are ended first
+                for process in (getattr(pool, '_processes', None) or dict()).values():
+                    process.terminate()
+                pool.shutdown(wait = False)
+            return None
+
+
+    def PoolPython(self):
+        #The python interpreter of this QGIS install, for the processes of the process pool: sys.executable
+        #when it is python, otherwise the python next to it or in sys.exec_prefix (pythonw.exe on Windows,
+        #so no console window opens). A candidate is only used when it runs and has the version of this
+        #python, the pool processes import the plugin with it. Returns None when there is none.
+        version = '{0}.{1}'.format(*sys.version_info[:2])
+        if os.name == 'nt':
+            names = ['pythonw.exe', 'python.exe']
+            folders = [sys.exec_prefix, os.path.dirname(sys.executable)]
+        else:
+            names = ['python' + version, 'python3', 'python']
+            folders = [os.path.join(sys.exec_prefix, 'bin'), os.path.join(os.path.dirname(sys.executable), 'bin'),
+                       os.path.dirname(sys.executable)]
+        candidates = []
+        if os.path.basename(sys.executable).lower().startswith('python'):
+            candidates.append(sys.executable)
+        candidates += [os.path.join(folder, name) for folder in folders for name in names]
+        for python in candidates:
+            if not os.path.isfile(python):
+                continue
+            try:
+                answer = subprocess.run([python, '-c', 'import sys; print("{0}.{1}".format(*sys.version_info[:2]))'],
+                                        stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, stdin = subprocess.DEVNULL,
+                                        timeout = self.pool_timeout, creationflags = getattr(subprocess, 'CREATE_NO_WINDOW', 0))
+            except Exception:
+                continue
+            if answer.returncode == 0 and answer.stdout.decode('ascii', 'replace').strip() == version:
+                return python
+        return None
+
+
+    def StopProcessPool(self, error):
+        #A broken pool (its processes could not be started or were killed) cannot take any more work,
+        #the rasters are then processed on the worker thread.
+        if self.post_pool != None:
+            print('The process pool stopped working, rasters are processed on the worker thread: {0}'.format(error))
+            self.post_pool.shutdown(wait = False)
+            self.post_pool = None
+
+
+    def DownloadCubes(self, m):
             for  cube_code in self.SelectedCubeCodes:
                 if self.isInterruptionRequested()  == False:
                     m+= 1
@@ -664,34 +991,152 @@ class WorkerThread(QTC.QThread):
                     
                     multiplier = self.cubedict[cube_code]['cubemeasure']['multiplier']
                     savefolder = os.path.join(self.base_save_folder, cube_code)
-                    os.makedirs(savefolder)
+                    os.makedirs(savefolder, exist_ok = True)
                     df_avail.to_csv(os.path.join(self.base_save_folder,cube_code +' list.csv'))
+                    #the stages below work on RasterTask records, built once from the columns of df_avail
+                    time_dimension = None
+                    for d in self.cubedict[cube_code]['cubedimensions']:
+                        if d['type'] == 'TIME':
+                            time_dimension = d['code']
+                    tasks = raster_tasks(cube_code, {key: df_avail[key].tolist() for key in df_avail.columns}, time_dimension)
                     
                    #self.ui.labelStatus.setText("Status: Constructing FAO Request")
                     if 'lcc' in cube_code.lower() and self.workspaces == 'WAPOR_2':
                         self.LCC_Legend(cube_code, savefolder)
                         pass
                     
-                    n = 0
-                    for index, row in df_avail.iterrows():
-                        if self.isInterruptionRequested()  == False:
-                            n+= 1            
-                            self.UpdateProgress.emit("Progress: Starting download for FAO data {0}. \nItem number {1} of {2} \nDownloading raster {3} of {4}".format(cube_code, m,  str(len(self.SelectedCubeCodes)), n,str(len(df_avail))))
-                            self.UpdateStatus.emit("Status: Requesting download URL from FAO")
-                            self.download_url = self.getCropRasterURL(cube_code, row) 
-                            
-                            self.UpdateStatus.emit("Status: Downloading")
-                            resp = requests.get(self.download_url)
-                            self.UpdateStatus.emit("Status: Correcting raster")
-                            self.Tiff_Edit_Save(cube_code,  multiplier, row, savefolder, resp)
-                            
-            if self.isInterruptionRequested()  == False:
-                self.UpdateStatus.emit("Status: Download Completed")
-                self.UpdateProgress.emit("")
+                    if self.profile['stack'] != 'NONE':
+                        extension = '.vrt' if self.profile['stack'] == 'VRT' else '.tif'
+                        self.stacks[cube_code] = TimeStack(os.path.join(self.base_save_folder, cube_code + ' stack' + extension),
+                                                           len(tasks), self.profile['stack'], self.profile)
+                    if self.profile['datacube'] != 'NONE':
+                        extension = '.nc' if self.profile['datacube'] == 'NetCDF' else '.zarr'
+                        self.datacubes[cube_code] = DataCube(os.path.join(self.base_save_folder, cube_code + extension),
+                                                             len(tasks), self.profile['datacube'], self.cubedict[cube_code]['cubemeasure'])
+                    try:
+                        self.PipelineRequest(cube_code, m, tasks, multiplier, savefolder)
+                    finally:
+                        if cube_code in self.stacks:
+                            self.stacks.pop(cube_code).close()
+                        if cube_code in self.datacubes:
+                            self.datacubes.pop(cube_code).close()
+
+
+    def PipelineRequest(self, cube_code, m, tasks, multiplier, savefolder):
+        #Keeps up to self.max_jobs CropRaster jobs running on the FAO server at once and
+        #hands each finished job to the download engine, instead of waiting
+        #for every job one after the other. Rasters are corrected as their downloads complete.
+        #Rasters that the manifest lists as done are skipped, so a resumed run only redoes unfinished work.
+        #Jobs submitted by the earlier run are polled with the new ones, resumed holds their urls so a job
+        #that is gone or failed on the server can be submitted again.
+        pending = collections.deque()
+        downloads = dict()
+        processing = dict()
+        resumed = set()
+        n = 0
+        for task in tasks:
+            entry = self.manifest.get(cube_code, task.raster_id)
+            download_file = self.raw_file(cube_code, task.raster_id)
+            if self.manifest.is_done(cube_code, task.raster_id, savefolder):
+                n += 1
+                self.AddToCubeFiles(cube_code, task, os.path.join(savefolder, entry['file']))
+            elif entry.get('state') == 'downloaded' and os.path.isfile(download_file):
+                n += 1
+                self.UpdateStatus.emit("Status: Correcting raster")
+                self.Tiff_Edit_Save(cube_code,  multiplier, task, savefolder, download_file, processing)
+            elif entry.get('state') == 'submitted' and entry.get('job_url'):
+                self.poller.add(entry['job_url'], task)
+                resumed.add(entry['job_url'])
             else:
-                self.UpdateStatus.emit("Status: Download Canceled")
-                self.UpdateProgress.emit("")
-                
+                pending.append(task)
+
+        while (pending or len(self.poller) or downloads or processing) and self.isInterruptionRequested()  == False:
+            while pending and len(self.poller) < self.max_jobs and self.isInterruptionRequested()  == False:
+                task = pending.popleft()
+                self.UpdateStatus.emit("Status: Requesting download URL from FAO")
+                job_url = self.submitCropRaster(cube_code, task)
+                if job_url != None:
+                    self.poller.add(job_url, task)
+                    self.manifest.update(cube_code, task.raster_id, state = 'submitted', job_url = job_url)
+                else:
+                    n += 1
+
+            for job_url, task, status, output in self.poller.tick():
+                if status == 'COMPLETED':
+                    self.StartDownload(cube_code, output, task, downloads)
+                elif job_url in resumed:
+                    print('Job {0} of the earlier run ended with status {1}, requesting the raster again'.format(job_url, status))
+                    pending.append(task)
+                else:
+                    n += 1
+                    print('Job {0} on the FAO server ended with status {1}'.format(job_url, status))
+                resumed.discard(job_url)
+
+            for future in [d for d in downloads if d.done()]:
+                task = downloads.pop(future)
+                n += 1
+                self.UpdateProgress.emit("Progress: Starting download for FAO data {0}. \nItem number {1} of {2} \nDownloading raster {3} of {4} \nReceived {5:.1f} MB".format(cube_code, m,  str(len(self.SelectedCubeCodes)), n,str(len(tasks)), self.engine.bytes_received / 1048576))
+                try:
+                    download_file = future.result()
+                except Exception as e:
+                    print('Download failed: {0}'.format(e))
+                    continue
+                self.manifest.update(cube_code, task.raster_id, state = 'downloaded')
+                self.UpdateStatus.emit("Status: Correcting raster")
+                self.Tiff_Edit_Save(cube_code,  multiplier, task, savefolder, download_file, processing)
+
+            for future in [p for p in processing if p.done()]:
+                task, args = processing.pop(future)
+                self.FinishRaster(cube_code, task, args, future)
+
+            #Sleeps until the next job is due to be checked, but wakes up early when a download
+            #or a correction finishes so it can be handled straight away.
+            if self.isInterruptionRequested()  == False:
+                next_due = self.poller.next_due()
+                delay = self.poll_interval if next_due == None else min(next_due, self.poll_interval)
+                if downloads or processing:
+                    concurrent.futures.wait(list(downloads) + list(processing), timeout = delay, return_when = concurrent.futures.FIRST_COMPLETED)
+                elif len(self.poller):
+                    time.sleep(delay)
+
+        #on cancel the rasters still waiting for the process pool are dropped, they keep their 'downloaded' state
+        for future in processing:
+            future.cancel()
+
+
+    def AddToCubeFiles(self, cube_code, task, outfilename):
+        #Band task.index + 1 of the cube's stack gets the raster, described by its file name and
+        #with the dimension captions, codes and descriptions of df_avail as band metadata.
+        #Step task.index of the cube's datacube gets the raster with the start of its TIME member as time.
+        if outfilename == None:
+            return
+        stack = self.stacks.get(cube_code)
+        if stack != None:
+            try:
+                stack.add(task.index + 1, outfilename, os.path.splitext(os.path.basename(outfilename))[0], task.metadata())
+            except Exception as e:
+                print('Could not add {0} to the stack: {1}'.format(outfilename, e))
+        datacube = self.datacubes.get(cube_code)
+        if datacube != None:
+            try:
+                datacube.add(task.index, outfilename, period_start(task.time_code) if task.time_code else None)
+            except Exception as e:
+                print('Could not add {0} to the datacube: {1}'.format(outfilename, e))
+
+
+    def StartDownload(self, cube_code, download_url, task, downloads):
+        self.download_url = download_url
+        self.UpdateStatus.emit("Status: Downloading")
+        download_file = self.raw_file(cube_code, task.raster_id)
+        downloads[self.engine.submit(self.download_url, download_file)] = task
+
+
+    def raw_file(self, cube_code, rasterID):
+        folder = os.path.join(self.temp_folder, cube_code)
+        os.makedirs(folder, exist_ok = True)
+        return os.path.join(folder, 'raw_{0}.tif'.format(rasterID))
+
+
     def Get_df(self, cube_code, Startdate, Enddate):
         time_range = '{0},{1}'.format(Startdate,Enddate)
         try:
@@ -702,50 +1147,88 @@ class WorkerThread(QTC.QThread):
             return
         
                 
-    def Tiff_Edit_Save(self, cube_code,  multiplier, row, savefolder, resp):                  
+    def Tiff_Edit_Save(self, cube_code,  multiplier, task, savefolder, download_file, processing):                  
       #check this works for seasonal and non seasonal
+      #The correction itself is done by process_raster in the process pool, processing maps its future to the task
+      #and the arguments of process_raster.
               try:   
-                  cube_dimensions = self.cubedict[cube_code]['cubedimensions']
-                  rasterID_index = (len(row) - 2)
-                  rasterID = row[rasterID_index]
-            
-                  time_code = ''
-                  if any('TIME' in d.values() for d in cube_dimensions):
-                      time_code_index = int(((len(row) - 2)/3))
-                      time_code = row[time_code_index]
-     
-                  filename = '{0}{1}.tif'.format(rasterID, time_code)
+                  filename = '{0}{1}.tif'.format(task.raster_id, task.time_code)
                   outfilename = os.path.join(savefolder,filename)       
-                  download_file = os.path.join(savefolder,'raw_{0}.tif'.format(rasterID))
                   ndays = 1
                   #By defualt dekadal data from WaPOR is an average. This allows it to give the cumulative value.
                   if any(d['code'] == 'DEKAD' for d in self.cubedict[cube_code]['cubedimensions']) and self.Combo  == 'Cumulative' and self.workspaces == 'WAPOR_2':
-                      timestr = time_code
-                      startdate = datetime.datetime.strptime(timestr[1:11],'%Y-%m-%d')
-                      enddate = datetime.datetime.strptime(timestr[12:22],'%Y-%m-%d')
+                      startdate, enddate = task.interval()
                       ndays = (enddate.timestamp()-startdate.timestamp())/86400
-                  open(download_file,'wb').write(resp.content)
-                  driver, NDV, xsize, ysize, GeoT, Projection = self.GetGeoInfo(download_file)
-                  Array = self.OpenAsArray(download_file,nan_values = True)
                   correction = multiplier * ndays
                   
-                  if(self.workspaces == 'ASIS' and cube_code != 'PHE'):
-                      CorrectedArray = np.multiply(Array, correction, out = Array, where = Array < 251)
-                  else:
-                      CorrectedArray = np.multiply(Array, correction, where = Array!=NDV)
-                      
-                  self.CreateGeoTiff(outfilename,CorrectedArray,
-                                    driver, NDV, xsize, ysize, GeoT, Projection)
-
-                  os.remove(download_file)          
+                  asis_flags = (self.workspaces == 'ASIS' and cube_code != 'PHE')
+                  cutline = None
+                  prepared = None
                   if self.CropChecked:
-                      gdal.Warp(os.path.join(savefolder,('Clip' + filename)), outfilename,cutlineDSName = self.vector_location, cropToCutline = (True), warpOptions = [ 'CUTLINE_ALL_TOUCHED=TRUE' ])#
-                      os.remove(outfilename)
-                      os.rename(os.path.join(savefolder,('Clip' + filename)), outfilename)
+                      prepared = self.PreparedCutline(download_file)
+                      cutline = prepared if prepared != None else self.vector_location
+                  args = (download_file, outfilename, correction, cutline, asis_flags, self.FusedClip,
+                          os.path.join(self.temp_folder, cube_code), self.memory_budget, self.profile, prepared != None)
+                  future = None
+                  if self.post_pool != None:
+                      try:
+                          future = self.post_pool.submit(process_raster, *args)
+                      except BrokenProcessPool as e:
+                          self.StopProcessPool(e)
+                  if future == None:
+                      future = self.ProcessInline(args)
+                  processing[future] = (task, args)
               except:
                   pass
 
 
+    def PreparedCutline(self, download_file):
+        #The cutline layer copied once per run to the temp folder, reprojected to the CRS of the rasters
+        #(and simplified to half a pixel when asked), so it is not read and reprojected again for every
+        #raster. Returns None when OGR cannot read the layer source, the rasters are then clipped with
+        #gdal.Warp reading the source itself.
+        SourceDS = gdal.Open(download_file)
+        projection = SourceDS.GetProjectionRef()
+        tolerance = abs(SourceDS.GetGeoTransform()[1]) / 2 if self.SimplifyCutline else None
+        SourceDS = None
+        key = (projection, tolerance)
+        if key not in self.cutlines:
+            path = os.path.join(self.temp_folder, 'cutline_{0}.geojson'.format(len(self.cutlines)))
+            try:
+                self.cutlines[key] = prepare_cutline(self.vector_location, path, projection, tolerance)
+            except Exception as e:
+                print('Could not prepare the cutline: {0}'.format(e))
+                self.cutlines[key] = None
+        return self.cutlines[key]
+
+
+    def ProcessInline(self, args):
+        #runs process_raster on the worker thread, as a finished future like the ones of the process pool
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(process_raster(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+    def FinishRaster(self, cube_code, task, args, future):
+        #Records a raster that process_raster has finished in the manifest and adds it to the cube's stack and datacube.
+        #A raster that failed keeps its 'downloaded' state, so resuming the run tries it again.
+        #When the process pool broke before or while processing the raster, it is processed on the worker thread instead.
+        if isinstance(future.exception(), BrokenProcessPool):
+            self.StopProcessPool(future.exception())
+            future = self.ProcessInline(args)
+        try:
+            outfilename, states, checksum = future.result()
+        except Exception as e:
+            print('Correcting raster {0} failed: {1}'.format(task.raster_id, e))
+            return
+        #the steps process_raster went through (corrected, clipped) are recorded in the same update
+        self.manifest.update(cube_code, task.raster_id, state = 'done', steps = states, file = os.path.basename(outfilename), checksum = checksum)
+        self.AddToCubeFiles(cube_code, task, outfilename)
+
+
     def getAvailData(self,cube_code,time_range):
         try:
             measure_code = self.cubedict[cube_code]['cubemeasure']['code']
@@ -754,7 +1237,9 @@ class WorkerThread(QTC.QThread):
         except:
             self.Mbox( 'Error' ,'Cannot get cube info',0)
            
-        df_dims_ls = []
+        #members of each row dimension by caption, so a ROW_HEADER is looked up without scanning all members
+        #and a caption can only match a member of its own dimension
+        members = dict()
         dims_ls = []
         columns_codes = ['MEASURES']
         rows_codes = []
@@ -764,7 +1249,7 @@ class WorkerThread(QTC.QThread):
                 if item['type']  == 'TIME': #get time dims
                     time_dims_code = item['code']
                     df_time, avalible_data = self._query_dimensionsMembers(cube_code,time_dims_code)
-                    df_dims_ls = df_dims_ls + avalible_data
+                    members[time_dims_code] = index_members(avalible_data)
                     time_dims = {
                         "code": time_dims_code,
                         "range": '[{0})'.format(time_range)
@@ -774,7 +1259,7 @@ class WorkerThread(QTC.QThread):
                 if item['type']  == 'WHAT':
                     dims_code = item['code']
                     df_dims , avalible_data = self._query_dimensionsMembers(cube_code,dims_code)
-                    df_dims_ls = df_dims_ls + avalible_data
+                    members[dims_code] = index_members(avalible_data)
                     members_ls = df_dims['code'].tolist()
                     what_dims = {
                             "code":item['code'],
@@ -784,60 +1269,14 @@ class WorkerThread(QTC.QThread):
   
                     rows_codes.append(item['code']) 
 
-            df = self._query_availData(cube_code,measure_code,
+            items = self._query_availData(cube_code,measure_code,
                              dims_ls,columns_codes,rows_codes)
         except:
             self.Mbox( 'Error' ,'Failed request cannot get list of available data',0)
             return None
         
-        keys = []
-        for item in rows_codes:
-            keys.append(item)
-            keys.append(item + '-code')
-            keys.append(item + '-description')
-       
-   
-        keys = keys + ['raster_id','bbox']
-        df_dict = { i : [] for i in keys }
-        for irow,row in df.iterrows():
-            header_count = 0
-            cell_count = 0
-            for i in range(len(row)): 
-                if row[i] == None:
-                    break
-                if row[i]['type']  == 'ROW_HEADER':
-                    key_info = row[i]['value']
-                    header_number = int(header_count * 3)
-                    df_dict[keys[header_number]].append(key_info)
-                    #df_dims_ls can get quite long
-                    #potentialy could be a quicker way to iterate through.
-                    for j in df_dims_ls:
-                        if j['caption'] ==  key_info:
-                            key= keys[header_number] + '-code'
-                            df_dict[key].append(j['code'])
-                            key= keys[header_number] + '-description'
-                            #Not all items have a description
-                            try:
-                                df_dict[key].append(j['description'])
-                            except:
-                                df_dict[key].append('NA')
-                            header_count += 1
-                            break
-
-                if row[i]['type']=='DATA_CELL':
-                    if cell_count != 0:
-                        k=0
-                        while k < len(df_dict)-2:
-                            key = keys[k]
-                            df_dict[key].append(df_dict[key][-1])
-                            k += 1
-                        
-                    raster_info=row[i]['metadata']['raster']    
-                    df_dict['raster_id'].append(raster_info['id'])
-                    df_dict['bbox'].append(raster_info['bbox'])
-                    cell_count += 1
-
-        df_sorted=pd.DataFrame.from_dict(df_dict)
+        #parsed straight from the JSON item lists, one list per column
+        df_sorted=pd.DataFrame.from_dict(parse_avail_items(items, rows_codes, members))
         return df_sorted            
     
     
@@ -848,7 +1287,7 @@ class WorkerThread(QTC.QThread):
                                     cube_code,
                                     dims_code
                                     )
-        resp = requests.get(request_url)
+        resp = self.session.get(request_url)
         resp_vp = resp.json()
         try:
             avail_items = resp_vp['response']
@@ -881,34 +1320,23 @@ class WorkerThread(QTC.QThread):
           }
         }
 
-        resp = requests.post(self.path_query, json = query_load)
+        resp = self.session.post(self.path_query, json = query_load)
         resp_vp = resp.json()
         print("_query_availData")
         print(resp_vp)
         try:
             results = resp_vp['response']['items']
-            #Some of the responces have duplicate items in them which need to be removed 
-            #the following section removes these duplicates.
-            #exception writen in for where the duplicates are intentional
-            if cube_code != 'EMS' and self.workspaces != 'GLEAM3':
-                for item in results:
-                    y = len(item)-1    
-                    while y > 0:
-                        if item[y] in item[:y]:
-                            item.remove(item[y])
-                            if y > len(item)-1:
-                                y -= 1
-                        else:
-                            y -= 1
-                            
-            return pd.DataFrame(results)
+            #Some of the responces have duplicate items in them which need to be removed,
+            #KEEP_DUPLICATES lists the cubes where the duplicates are intentional
+            return remove_duplicate_cells(results, self.workspaces, cube_code)
         
         except:
             self.Mbox( 'Error' ,'Cannot get list of available data.'+str(resp_vp['message']),0)
         
             
-    def getCropRasterURL(self,cube_code,
-                          row):
+    def submitCropRaster(self,cube_code,
+                          task):
+        #Posts the CropRaster job and returns the job url without waiting for it to finish.
         #Create Polygon        
         xmin,ymin,xmax,ymax = self.bbox[0], self.bbox[1], self.bbox[2], self.bbox[3]
         Polygon = [
@@ -919,17 +1347,8 @@ class WorkerThread(QTC.QThread):
                   [xmin,ymin]
                 ]
         cube_measure_code = self.cubedict[cube_code]['cubemeasure']['code']
-        dimension_params = []
-        rasterID_index = (len(row) - 2)
-        rasterID = row[rasterID_index]
-        x=0
-        while x < (len(row)-2):
-            i_code = int(x+1)                         
-            dimension_params.append({
-            "code": row.index[x],
-            "values": [row[i_code]]
-            })
-            x += 3
+        dimension_params = task.dimension_params()
+        rasterID = task.raster_id
  
         #Query payload
         query_crop_raster = {
@@ -964,97 +1383,34 @@ class WorkerThread(QTC.QThread):
         }
         
         self.CheckAccessToken()
-        resp_vp = requests.post(self.path_query,
+        resp_vp = self.session.post(self.path_query,
                               headers = {'Authorization':'Bearer {0}'.format(self.AccessToken)},
                                                         json = query_crop_raster)
         resp_vp = resp_vp.json()
-        print("getCropRasterURL")
+        print("submitCropRaster")
         print(resp_vp)
         try:
             job_url = resp_vp['response']['links'][0]['href']
-            download_url = self._query_jobOutput(job_url)
-            return download_url     
+            return job_url
         except:
             self.Mbox( 'Error' ,'Cannot get cropped raster URL',0)
   
     
-    def _query_jobOutput(self,job_url):
-     #This method queries the FAO sever until the download is ready which it then returns.
-     contiue = True        
-     while contiue:        
-         resp = requests.get(job_url)
-         resp = resp.json()
-         jobType = resp['response']['type'] 
-                
-         if resp['response']['status']  == 'COMPLETED':
-             contiue = False
-             if jobType  == 'CROP RASTER':
-                 output = resp['response']['output']['downloadUrl']                
-             elif jobType  == 'AREA STATS':
-                 results = resp['response']['output']
-                 output = pd.DataFrame(results['items'], columns = results['header'])
-             else:
-                 pass                
-             return output
-         if resp['response']['status']  == 'COMPLETED WITH ERRORS':
-             contiue = False    
-         #Method keeps pinging the sever till the request is done. Short delay to minimize the number of requests.       
-         time.sleep(2)
-
-    
-    def GetGeoInfo(self, fh, subdataset = 0):
-
-        SourceDS = gdal.Open(fh, gdal.GA_Update)
-        Type = SourceDS.GetDriver().ShortName
-        if Type  == 'HDF4' or Type  == 'netCDF':
-            SourceDS = gdal.Open(SourceDS.GetSubDatasets()[subdataset][0])
-        NDV = SourceDS.GetRasterBand(1).GetNoDataValue()
-        xsize = SourceDS.RasterXSize
-        ysize = SourceDS.RasterYSize
-        GeoT = SourceDS.GetGeoTransform()
-        Projection = osr.SpatialReference()
-        Projection.ImportFromWkt(SourceDS.GetProjectionRef())
-        driver = gdal.GetDriverByName(Type)
-        return driver, NDV, xsize, ysize, GeoT, Projection    
-    
-
-    def OpenAsArray(self, fh, bandnumber = 1, dtype = 'float32', nan_values = False):
-
-        datatypes = {"uint8": np.uint8, "int8": np.int8, "uint16": np.uint16, "int16":  np.int16, "Int16":  np.int16, "uint32": np.uint32,
-        "int32": np.int32, "float32": np.float32, "float64": np.float64, "complex64": np.complex64, "complex128": np.complex128,
-        "Int32": np.int32, "Float32": np.float32, "Float64": np.float64, "Complex64": np.complex64, "Complex128": np.complex128,}
-        DataSet = gdal.Open(fh, gdal.GA_Update)
-        Type = DataSet.GetDriver().ShortName
-        if Type  == 'HDF4':
-            Subdataset = gdal.Open(DataSet.GetSubDatasets()[bandnumber][0])
-            NDV = int(Subdataset.GetMetadata()['_FillValue'])
-        else:
-            Subdataset = DataSet.GetRasterBand(bandnumber)
-            NDV = Subdataset.GetNoDataValue()
-        Array = Subdataset.ReadAsArray().astype(datatypes[dtype])
-        if nan_values:
-            Array[Array  == NDV] = np.nan
-        return Array
-   
-    
-    def CreateGeoTiff(self, fh, Array, driver, NDV, xsize, ysize, GeoT, Projection, explicit = True, compress = None):
-        
-        datatypes = {"uint8": 1, "int8": 1, "uint16": 2, "int16": 3, "Int16": 3, "uint32": 4,
-        "int32": 5, "float32": 6, "float64": 7, "complex64": 10, "complex128": 11,
-        "Int32": 5, "Float32": 6, "Float64": 7, "Complex64": 10, "Complex128": 11,}
-        if compress != None:
-            DataSet2 = driver.Create(fh,xsize,ysize,1,datatypes[Array.dtype.name], ['COMPRESS={0}'.format(compress)])
-        else:
-            DataSet2 = driver.Create(fh,xsize,ysize,1,datatypes[Array.dtype.name])
-        if NDV is None:
-            NDV = -9999
-        if explicit:
-            Array[np.isnan(Array)] = NDV
-        DataSet2.GetRasterBand(1).SetNoDataValue(NDV)
-        DataSet2.SetGeoTransform(GeoT)
-        DataSet2.SetProjection(Projection.ExportToWkt())
-        DataSet2.GetRasterBand(1).WriteArray(Array)
-        DataSet2 = None
-        if "nt" not in Array.dtype.name:
-            Array[Array  == NDV] = np.nan 
-            
+    def _check_jobOutput(self,job_url):
+     #Asks the FAO server once for the state of a job and returns (status, output).
+     #output is only filled in once the job is COMPLETED.
+     resp = self.session.get(job_url)
+     if resp.status_code == 404:
+         #the job is not known on the server (anymore), for example a job of a run resumed days later
+         return 'FAILED', None
+     resp = resp.json()
+     jobType = resp['response']['type'] 
+     status = resp['response']['status']
+     output = None
+     if status  == 'COMPLETED':
+         if jobType  == 'CROP RASTER':
+             output = resp['response']['output']['downloadUrl']                
+         elif jobType  == 'AREA STATS':
+             results = resp['response']['output']
+             output = pd.DataFrame(results['items'], columns = results['header'])
+     return status, output
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ FAODownloader
+                                 A QGIS plugin
+ Connections to the FAO API used by the dialog and the download worker:
+ the shared session, the catalog cache, the download engine and the job
+ poller. Nothing in here depends on Qt.
+                             -------------------
+        begin                : 2022-07-26
+        git sha              : $Format:%H$
+        copyright            : (C) 2022 by Brenden & Celray James
+        email                : bvissers929@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import random
+import requests
+import requests.adapters
+import threading
+import time
+import urllib.parse
+from urllib3.util.retry import Retry
+
+
+class FAORetry(Retry):
+    #Retry policy of the FAOSession. GET and the other idempotent methods are retried on connection
+    #errors, read timeouts, 429 and 5xx answers. A POST (CropRaster jobs, MDAQuery) may already have
+    #been carried out by the server when its answer is lost, so it is only retried when the connection
+    #could not be made or the server answered 429, never after a read timeout or a 5xx answer.
+    def is_retry(self, method, status_code, has_retry_after = False):
+        if method.upper() == 'POST':
+            return status_code == 429
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+class FAOSession(requests.Session):
+    #requests session that is shared by the dialog and the worker so every call to the FAO API
+    #reuses pooled keep-alive connections. Failed calls are retried with an increasing delay (see
+    #FAORetry) and every call gets a default timeout. A read timeout is retried only once, so a call
+    #cannot hang for much longer than twice the read timeout.
+    def __init__(self, timeout = (10, 120), retries = 5, backoff = 1, pool_size = 32):
+        super().__init__()
+        self.timeout = timeout
+        retry = FAORetry(total = retries, read = 1, backoff_factor = backoff,
+                         status_forcelist = [429, 500, 502, 503, 504],
+                         respect_retry_after_header = True, raise_on_status = False)
+        adapter = requests.adapters.HTTPAdapter(pool_connections = 4, pool_maxsize = pool_size, max_retries = retry)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    #Returns the FAOSession shared by the whole plugin, creating it on first use.
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = FAOSession()
+        return _session
+
+
+class CatalogCache:
+    #On-disk copy of catalog responses from the FAO API, one JSON file per request url.
+    #A copy younger than ttl seconds is used as it is. An older copy is revalidated with the
+    #ETag/Last-Modified headers the server sent with it, so it is only downloaded again when
+    #it changed. When the server cannot be reached the old copy is used.
+    def __init__(self, folder = None, ttl = 86400):
+        if folder == None:
+            folder = os.path.join(os.path.dirname(__file__), 'cache')
+        self.folder = folder
+        self.ttl = ttl
+        self.session = get_session()
+
+
+    def _path(self, url):
+        return os.path.join(self.folder, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+
+    def cached(self, url):
+        #returns the stored entry for url, even when it is out of date, or None
+        path = self._path(url)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, 'r', encoding = 'utf-8') as g:
+                return json.load(g)
+        except ValueError:
+            return None
+
+
+    def is_fresh(self, entry):
+        return entry != None and time.time() - entry['fetched'] < self.ttl
+
+
+    def _store(self, url, entry):
+        if not os.path.isdir(self.folder): os.makedirs(self.folder, exist_ok = True)
+        path = self._path(url)
+        tmp_path = '{0}.{1}.tmp'.format(path, threading.get_ident())
+        with open(tmp_path, 'w', encoding = 'utf-8') as g:
+            json.dump(entry, g)
+        os.replace(tmp_path, path)
+
+
+    def revalidate(self, url, entry = None):
+        #Asks the server for url, sending the validators of entry when there is one.
+        #Returns (json, changed).
+        headers = {}
+        if entry != None and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry != None and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        resp = self.session.get(url, headers = headers)
+        if resp.status_code == 304 and entry != None:
+            entry['fetched'] = time.time()
+            self._store(url, entry)
+            return entry['json'], False
+        resp.raise_for_status()
+        data = resp.json()
+        changed = entry == None or entry['json'] != data
+        #error answers from the API are passed on but not kept
+        if data.get('status', 200) == 200:
+            self._store(url, {'url': url, 'fetched': time.time(),
+                              'etag': resp.headers.get('ETag'),
+                              'last_modified': resp.headers.get('Last-Modified'),
+                              'json': data})
+        return data, changed
+
+
+    def revalidate_all(self, urls, entries = None):
+        #Revalidates several urls at the same time, so the wait is as long as the slowest
+        #request instead of all of them added up. Returns a (json, changed) pair per url.
+        if entries == None:
+            entries = [self.cached(url) for url in urls]
+        with concurrent.futures.ThreadPoolExecutor(max_workers = max(1, len(urls))) as executor:
+            return list(executor.map(self.revalidate, urls, entries))
+
+
+    def get_all(self, urls):
+        #get() for several urls at the same time, out of date copies are revalidated in parallel.
+        #A url that fails does not fail the others, it gets an error answer like the API's own
+        #({'status': ..., 'message': ...}) instead.
+        with concurrent.futures.ThreadPoolExecutor(max_workers = max(1, min(16, len(urls)))) as executor:
+            return list(executor.map(self._get_or_error, urls))
+
+
+    def _get_or_error(self, url):
+        try:
+            return self.get(url)
+        except requests.HTTPError as e:
+            #the error answer of the API carries the message that is shown to the user
+            try:
+                data = e.response.json()
+            except ValueError:
+                data = None
+            if isinstance(data, dict) and data.get('message'):
+                data.setdefault('status', e.response.status_code)
+                return data
+            return {'status': e.response.status_code, 'message': str(e)}
+        except Exception as e:
+            return {'status': None, 'message': str(e)}
+
+
+    def get(self, url):
+        entry = self.cached(url)
+        if self.is_fresh(entry):
+            return entry['json']
+        try:
+            return self.revalidate(url, entry)[0]
+        except Exception:
+            if entry != None:
+                return entry['json']
+            raise
+
+
+class DownloadEngine:
+    #Thread pool that transfers several rasters at the same time while the
+    #WorkerThread keeps polling the FAO server for the next finished jobs.
+    #max_per_host limits how many of the transfers may go to the same server.
+    #Rasters are streamed to disk in chunks so memory use does not grow with the raster size.
+    def __init__(self, max_workers = 4, max_per_host = 4, chunk_size = 1024 * 1024):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = max_workers)
+        self.max_per_host = max_per_host
+        self.chunk_size = chunk_size
+        self.host_slots = dict()
+        self.lock = threading.Lock()
+        self.futures = []
+        self.session = get_session()
+        self.bytes_received = 0
+
+
+    def _host_slot(self, url):
+        host = urllib.parse.urlparse(url).netloc
+        with self.lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self.host_slots[host]
+
+
+    def _fetch(self, url, download_file):
+        #Writes to a .part file first so a half transferred raster is never mistaken for a complete one.
+        #A .part file left behind by an earlier run is continued with an HTTP Range request.
+        part_file = download_file + '.part'
+        headers = {'Accept-Encoding': 'identity'}
+        with self._host_slot(url):
+            offset = os.path.getsize(part_file) if os.path.isfile(part_file) else 0
+            if offset:
+                headers['Range'] = 'bytes={0}-'.format(offset)
+            resp = self.session.get(url, stream = True, headers = headers)
+            if resp.status_code == 416:
+                #the partial file does not match the raster on the server anymore, start from the beginning
+                resp.close()
+                del headers['Range']
+                resp = self.session.get(url, stream = True, headers = headers)
+            with resp:
+                resp.raise_for_status()
+                if resp.status_code != 206:
+                    offset = 0
+                expected = resp.headers.get('Content-Length')
+                written = 0
+                with open(part_file, 'ab' if offset else 'wb') as g:
+                    for chunk in resp.iter_content(chunk_size = self.chunk_size):
+                        g.write(chunk)
+                        written += len(chunk)
+                        with self.lock:
+                            self.bytes_received += len(chunk)
+        #Content-Length is the size on the wire, so it can only be checked when the body was not encoded
+        if expected != None and resp.headers.get('Content-Encoding') in (None, 'identity') and written != int(expected):
+            os.remove(part_file)
+            raise IOError('Incomplete download of {0}: received {1} of {2} bytes'.format(url, written, expected))
+        os.replace(part_file, download_file)
+        return download_file
+
+
+    def submit(self, url, download_file):
+        future = self.executor.submit(self._fetch, url, download_file)
+        self.futures = [f for f in self.futures if not f.done()] + [future]
+        return future
+
+
+    def shutdown(self, cancel = False):
+        if cancel:
+            for future in self.futures:
+                future.cancel()
+        self.executor.shutdown(wait = True)
+        self.futures = []
+
+
+class JobPoller:
+    #Keeps track of every job that is running on the FAO server and decides when each one
+    #is asked for its status again. The first check is made soon after submitting, after that
+    #the delay doubles (with some jitter so jobs do not line up) up to max_interval. Once jobs
+    #have finished, their average run time is used to skip checks that are unlikely to succeed.
+    #All jobs that are due are checked together in one tick.
+    TERMINAL = ('COMPLETED', 'COMPLETED WITH ERRORS', 'FAILED', 'CANCELED', 'CANCELLED')
+
+    def __init__(self, check, first_interval = 1, max_interval = 30, deadline = 3600, jitter = 0.2, max_workers = 8):
+        self.check = check
+        self.first_interval = first_interval
+        self.max_interval = max_interval
+        self.deadline = deadline
+        self.jitter = jitter
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = max_workers)
+        self.jobs = dict()
+        self.latency = None
+
+
+    def __len__(self):
+        return len(self.jobs)
+
+
+    def add(self, job_url, tag = None):
+        now = time.time()
+        job = {'tag': tag, 'submitted': now, 'interval': self.first_interval}
+        self._schedule(job, now)
+        self.jobs[job_url] = job
+
+
+    def _schedule(self, job, now):
+        delay = job['interval']
+        if self.latency != None and job['submitted'] + self.latency > now + delay:
+            #not worth asking before the job is expected to be done
+            delay = job['submitted'] + self.latency - now
+        else:
+            job['interval'] = min(job['interval'] * 2, self.max_interval)
+        delay = min(delay, self.max_interval)
+        job['next_poll'] = now + delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+    def next_due(self):
+        #seconds until the next job has to be checked
+        if not self.jobs:
+            return None
+        return max(0, min(job['next_poll'] for job in self.jobs.values()) - time.time())
+
+
+    def _safe_check(self, job_url):
+        try:
+            return self.check(job_url)
+        except Exception as e:
+            print('Could not check job {0}: {1}'.format(job_url, e))
+            return None, None
+
+
+    def tick(self):
+        #Checks all jobs that are due and returns (job_url, tag, status, output) for every job that
+        #finished, failed or ran past the deadline. Those jobs are no longer tracked afterwards.
+        now = time.time()
+        due = [job_url for job_url, job in self.jobs.items() if job['next_poll'] <= now]
+        finished = []
+        for job_url, (status, output) in zip(due, self.executor.map(self._safe_check, due)):
+            job = self.jobs[job_url]
+            now = time.time()
+            if status in self.TERMINAL:
+                del self.jobs[job_url]
+                if status == 'COMPLETED':
+                    observed = now - job['submitted']
+                    self.latency = observed if self.latency == None else 0.7 * self.latency + 0.3 * observed
+                finished.append((job_url, job['tag'], status, output))
+            elif now - job['submitted'] > self.deadline:
+                del self.jobs[job_url]
+                finished.append((job_url, job['tag'], 'TIMEOUT', None))
+            else:
+                self._schedule(job, now)
+        return finished
+
+
+    def shutdown(self):
+        self.executor.shutdown(wait = True)
+        self.jobs = dict()
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ FAODownloader
+                                 A QGIS plugin
+ Parsing of the FAO catalog and query responses used by the download
+ worker. Nothing in here depends on Qt or pandas.
+                             -------------------
+        begin                : 2022-07-26
+        git sha              : $Format:%H$
+        copyright            : (C) 2022 by Brenden & Celray James
+        email                : bvissers929@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import datetime
+
+
+#Cubes whose table rows repeat cells on purpose, as (workspace, cube code) where None matches any.
+#The rows of all other cubes have their duplicate cells removed.
+KEEP_DUPLICATES = {(None, 'EMS'), ('GLEAM3', None)}
+
+
+def keeps_duplicates(workspace, cube_code):
+    return ((workspace, cube_code) in KEEP_DUPLICATES or (None, cube_code) in KEEP_DUPLICATES
+            or (workspace, None) in KEEP_DUPLICATES)
+
+
+def freeze(value):
+    #hashable copy of a JSON value, equal values give equal keys
+    if isinstance(value, dict):
+        return tuple(sorted((key, freeze(v)) for key, v in value.items()))
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def unique_cells(item):
+    #The cells of a table row without duplicates, in one pass. Like the list.remove loop it replaces,
+    #the last copy of a repeated cell is kept and the cells stay in the order of their last copy.
+    seen = set()
+    cells = []
+    for cell in reversed(item):
+        key = freeze(cell)
+        if key not in seen:
+            seen.add(key)
+            cells.append(cell)
+    cells.reverse()
+    return cells
+
+
+def remove_duplicate_cells(items, workspace, cube_code):
+    #Some of the responses have duplicate cells in their rows which need to be removed,
+    #except for the cubes in KEEP_DUPLICATES.
+    if keeps_duplicates(workspace, cube_code):
+        return items
+    return [unique_cells(item) for item in items]
+
+
+def index_members(avalible_data):
+    #caption -> member of one dimension, the first member wins when captions repeat
+    index = dict()
+    for member in avalible_data:
+        index.setdefault(member['caption'], member)
+    return index
+
+
+def avail_keys(rows_codes):
+    #column names of the availability list: caption, code and description of each row dimension
+    keys = []
+    for code in rows_codes:
+        keys.append(code)
+        keys.append(code + '-code')
+        keys.append(code + '-description')
+    return keys + ['raster_id', 'bbox']
+
+
+def parse_avail_items(items, rows_codes, members):
+    #Columns of the availability list, straight from the item lists of an MDAQuery_Table response.
+    #Each item is a table row: ROW_HEADER cells with the caption of each row dimension, followed by
+    #one DATA_CELL per raster. members holds the caption -> member index of each dimension.
+    #Returns a dict of equally long lists, one per avail_keys column, ready for pd.DataFrame.
+    keys = avail_keys(rows_codes)
+    columns = {key: [] for key in keys}
+    header_columns = [columns[key] for key in keys[:-2]]
+    raster_ids = columns['raster_id']
+    bboxes = columns['bbox']
+    dimension_members = [members[code] for code in rows_codes]
+    for item in items:
+        header_count = 0
+        cell_count = 0
+        for cell in item:
+            if cell == None:
+                break
+            kind = cell['type']
+            if kind == 'ROW_HEADER':
+                caption = cell['value']
+                header_number = header_count * 3
+                header_columns[header_number].append(caption)
+                member = dimension_members[header_count].get(caption) if header_count < len(rows_codes) else None
+                if member != None:
+                    header_columns[header_number + 1].append(member['code'])
+                    #Not all items have a description
+                    header_columns[header_number + 2].append(member.get('description', 'NA'))
+                    header_count += 1
+            elif kind == 'DATA_CELL':
+                #every raster of the row gets the captions, codes and descriptions of the row headers
+                if cell_count != 0:
+                    for column in header_columns:
+                        column.append(column[-1])
+                raster = cell['metadata']['raster']
+                raster_ids.append(raster['id'])
+                bboxes.append(raster['bbox'])
+                cell_count += 1
+    return columns
+
+
+class RasterTask:
+    #One raster of the availability list, built once by raster_tasks and passed through the submit,
+    #download, naming and correction stages instead of a pandas row.
+    #index is the position in the list, members the dimension code -> member code the CropRaster job
+    #asks for, captions and descriptions the same for the member captions and descriptions, and
+    #time_code the member code of the TIME dimension (for example '[2009-01-01,2009-01-11)') or ''.
+    __slots__ = ('index', 'cube_code', 'members', 'captions', 'descriptions', 'time_code', 'raster_id', 'bbox')
+
+    def __init__(self, index, cube_code, members, captions, descriptions, time_code, raster_id, bbox):
+        self.index = index
+        self.cube_code = cube_code
+        self.members = members
+        self.captions = captions
+        self.descriptions = descriptions
+        self.time_code = time_code
+        self.raster_id = raster_id
+        self.bbox = bbox
+
+    def __repr__(self):
+        return 'RasterTask({0!r}, {1!r}, {2!r})'.format(self.index, self.cube_code, self.raster_id)
+
+    def dimension_params(self):
+        #the "dimensions" of a CropRaster query
+        return [{'code': code, 'values': [member]} for code, member in self.members.items()]
+
+    def metadata(self):
+        #the availability list columns of this raster, without raster_id and bbox
+        metadata = dict()
+        for code in self.members:
+            metadata[code] = str(self.captions[code])
+            metadata[code + '-code'] = str(self.members[code])
+            metadata[code + '-description'] = str(self.descriptions[code])
+        return metadata
+
+    def interval(self):
+        #start and end date of time_code, None when it is not a '[start,end)' interval
+        try:
+            return (datetime.datetime.strptime(self.time_code[1:11], '%Y-%m-%d'),
+                    datetime.datetime.strptime(self.time_code[12:22], '%Y-%m-%d'))
+        except (TypeError, ValueError):
+            return None
+
+
+def raster_tasks(cube_code, columns, time_dimension = None):
+    #RasterTasks from the columns of the availability list (as made by parse_avail_items),
+    #time_dimension is the code of the cube's TIME dimension.
+    rows_codes = [key for key in columns if key + '-code' in columns]
+    tasks = []
+    for index, raster_id in enumerate(columns['raster_id']):
+        members = {code: columns[code + '-code'][index] for code in rows_codes}
+        captions = {code: columns[code][index] for code in rows_codes}
+        descriptions = {code: columns[code + '-description'][index] for code in rows_codes}
+        time_code = members.get(time_dimension, '') if time_dimension != None else ''
+        tasks.append(RasterTask(index, cube_code, members, captions, descriptions, time_code,
+                                raster_id, columns['bbox'][index]))
+    return tasks
+
+
+class Catalog:
+    #The cubes of one workspace, indexed by code, by level tag and by spatialExtent so the dialog,
+    #the info popup and the download worker look a cube up without scanning the list.
+    #groups is a list of (tag, cubes) pairs, one per catalog request (the tag is 'L1', 'L2' or 'L3' for
+    #WAPOR_2 and None for the other workspaces). Iterating gives the cubes in the order they were added.
+    def __init__(self, groups = ()):
+        self.cubes = dict()
+        self.levels = dict()
+        self.extents = dict()
+        for tag, cubes in groups:
+            self.add(tag, cubes)
+
+    def add(self, tag, cubes):
+        level = self.levels.setdefault(tag, [])
+        extents = self.extents.setdefault(tag, dict())
+        for cube in cubes:
+            #codes are looked up as the text of the tree items
+            self.cubes[str(cube.get('code'))] = cube
+            level.append(cube)
+            extent = (cube.get('additionalInfo') or {}).get('spatialExtent')
+            extents.setdefault(extent, []).append(cube)
+
+    def __iter__(self):
+        return iter(self.cubes.values())
+
+    def __len__(self):
+        return len(self.cubes)
+
+    def __contains__(self, code):
+        return str(code) in self.cubes
+
+    def get(self, code, default = None):
+        return self.cubes.get(str(code), default)
+
+    def level(self, tag):
+        #the cubes of one level tag, in catalog order
+        return self.levels.get(tag, [])
+
+    def by_extent(self, tag):
+        #spatialExtent -> cubes of one level tag, the extents in the order they first appear
+        return self.extents.get(tag, dict())
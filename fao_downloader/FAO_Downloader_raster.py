@@ -0,0 +1,814 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ FAODownloader
+                                 A QGIS plugin
+ Raster post-processing and the run manifest used by the download worker.
+ Nothing in here depends on Qt, so it can also run outside of QGIS.
+                             -------------------
+        begin                : 2022-07-26
+        git sha              : $Format:%H$
+        copyright            : (C) 2022 by Brenden & Celray James
+        email                : bvissers929@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import datetime
+import hashlib
+import json
+import math
+import numpy as np
+import os
+from osgeo import gdal, ogr, osr
+import re
+import tempfile
+import time
+from xml.sax.saxutils import escape
+
+#netCDF4 and zarr are only needed for the datacube export and are not part of a QGIS install
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+
+DEFAULT_NDV = -9999
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+#How the finished rasters are written. format is 'GTiff' or 'COG' (Cloud Optimized GeoTIFF),
+#compress is 'NONE', 'DEFLATE', 'ZSTD' or 'LZW'. With native_dtype the integer values of the
+#server are kept and the correction is stored as the scale of the band instead of applied.
+#stack is 'NONE', 'VRT' or 'GTiff', the time steps of each cube are also collected in one multi-band file.
+#datacube is 'NONE', 'NetCDF' or 'Zarr', each cube is also written as a datacube with a time coordinate.
+DEFAULT_PROFILE = {'format': 'GTiff', 'compress': 'NONE', 'predictor': False, 'tiled': False, 'overviews': False,
+                   'native_dtype': False, 'stack': 'NONE', 'datacube': 'NONE'}
+
+
+def output_profile(**kwargs):
+    profile = dict(DEFAULT_PROFILE)
+    profile.update(kwargs)
+    return profile
+
+
+def load_profile(path):
+    #Reads an output profile from a JSON file, missing keys get their default value.
+    #The dialog saves its choice to the same kind of file, so runs without the dialog can use it too.
+    if not os.path.isfile(path):
+        return output_profile()
+    with open(path, 'r', encoding = 'utf-8') as g:
+        return output_profile(**json.load(g))
+
+
+def save_profile(path, profile):
+    with open(path, 'w', encoding = 'utf-8') as g:
+        json.dump(profile, g, indent = 1)
+
+
+def creation_options(profile, data_type = gdal.GDT_Float32):
+    #GDAL creation options for the output profile
+    compress = str(profile.get('compress', 'NONE')).upper()
+    floating = data_type in (gdal.GDT_Float32, gdal.GDT_Float64)
+    options = []
+    if profile.get('format') == 'COG':
+        #COG files are always tiled
+        options += ['COMPRESS={0}'.format(compress), 'BLOCKSIZE=512',
+                    'OVERVIEWS={0}'.format('AUTO' if profile.get('overviews') else 'NONE')]
+        if profile.get('predictor') and compress != 'NONE':
+            options.append('PREDICTOR=YES')
+    else:
+        if compress != 'NONE':
+            options.append('COMPRESS={0}'.format(compress))
+            if profile.get('predictor'):
+                options.append('PREDICTOR={0}'.format(3 if floating else 2))
+        if profile.get('tiled'):
+            options += ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512']
+    options.append('BIGTIFF=IF_SAFER')
+    return options
+
+
+def finish_output(dst_file, profile):
+    #Adds internal overviews to GeoTIFF outputs when the profile asks for them, COG outputs have them already.
+    if profile == None or profile.get('format') == 'COG' or not profile.get('overviews'):
+        return
+    DataSet = gdal.Open(dst_file, gdal.GA_Update)
+    levels = []
+    size = max(DataSet.RasterXSize, DataSet.RasterYSize)
+    while size > 256:
+        levels.append(2 ** (len(levels) + 1))
+        size //= 2
+    if levels:
+        DataSet.BuildOverviews('AVERAGE', levels)
+    DataSet = None
+
+
+def write_output(src, dst_file, profile, data_type = gdal.GDT_Float32):
+    #Copies src (a file name or dataset) to dst_file in the output profile.
+    gdal.Translate(dst_file, src, format = profile.get('format', 'GTiff'), creationOptions = creation_options(profile, data_type))
+    finish_output(dst_file, profile)
+    return dst_file
+
+
+def read_physical(src_file, band_number = 1, xoff = 0, yoff = 0, xsize = None, ysize = None):
+    #Reads (a window of) a band as float32 in physical units: scale and offset applied and NoData as NaN.
+    #Rasters saved with native_dtype keep their integers on disk, this is where they become floats.
+    DataSet = gdal.Open(src_file)
+    band = DataSet.GetRasterBand(band_number)
+    NDV = band.GetNoDataValue()
+    Raw = band.ReadAsArray(xoff, yoff, xsize, ysize)
+    Array = Raw.astype(np.float32)
+    scale = band.GetScale()
+    offset = band.GetOffset()
+    if scale not in (None, 1):
+        Array *= np.float32(scale)
+    if offset not in (None, 0):
+        Array += np.float32(offset)
+    if NDV is not None:
+        Array[Raw == NDV] = np.nan
+    DataSet = None
+    return Array
+
+
+def file_checksum(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as g:
+        for block in iter(lambda: g.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class RunManifest:
+    #JSON file kept next to the '<cube> list.csv' files of a run. It records how far every
+    #raster got (submitted, downloaded, done) so a canceled or crashed run can be resumed into
+    #the same folder without redoing the finished rasters.
+    #Changes are written at most every save_interval seconds and by flush() at the end of the run,
+    #a crash only loses the last few seconds, which the resumed run redoes.
+    FILENAME = 'manifest.json'
+
+    def __init__(self, folder, save_interval = 10):
+        self.path = os.path.join(folder, self.FILENAME)
+        self.data = {'cubes': {}}
+        if os.path.isfile(self.path):
+            with open(self.path, 'r', encoding = 'utf-8') as g:
+                self.data = json.load(g)
+        self.save_interval = save_interval
+        self.saved = time.time()
+        self.dirty = False
+
+
+    def get(self, cube_code, raster_id):
+        return self.data['cubes'].get(cube_code, {}).get(raster_id, {})
+
+
+    def update(self, cube_code, raster_id, **kwargs):
+        entry = self.data['cubes'].setdefault(cube_code, {}).setdefault(raster_id, {})
+        entry.update(kwargs)
+        self.dirty = True
+        if time.time() - self.saved >= self.save_interval:
+            self.save()
+
+
+    def is_done(self, cube_code, raster_id, folder):
+        #True when the raster is recorded as done and its file in folder still has the checksum it was saved with
+        entry = self.get(cube_code, raster_id)
+        if entry.get('state') != 'done':
+            return False
+        path = os.path.join(folder, entry.get('file', ''))
+        if not os.path.isfile(path):
+            return False
+        return entry.get('checksum') == None or file_checksum(path) == entry['checksum']
+
+
+    def flush(self):
+        if self.dirty:
+            self.save()
+
+
+    def save(self):
+        #written to a temporary file first so a crash never leaves a half written manifest
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding = 'utf-8') as g:
+            json.dump(self.data, g)
+        os.replace(tmp_path, self.path)
+        self.saved = time.time()
+        self.dirty = False
+
+
+def window_rows(band, xsize, ysize, memory_budget, bytes_per_pixel):
+    #Number of rows that are processed at once. Windows span the full raster width and are a
+    #whole number of native block rows high, so every block is read from disk only once.
+    block_height = max(1, band.GetBlockSize()[1])
+    rows = int(memory_budget // max(1, xsize * bytes_per_pixel))
+    rows = max(block_height, rows // block_height * block_height)
+    return min(rows, ysize)
+
+
+def float_size(src_file):
+    #bytes the first band of src_file takes as float32
+    SourceDS = gdal.Open(src_file)
+    return SourceDS.RasterXSize * SourceDS.RasterYSize * 4
+
+
+def correct_block(Out, Mask, correction, NDV, asis_flags = False):
+    #Multiplies the float32 block Out by correction in place, Mask is a preallocated bool buffer of the
+    #same shape. Pixels equal to NDV are not multiplied, so they stay NoData, and with asis_flags
+    #neither are the flag values (251 and up). Allocates nothing, except with asis_flags and a NDV:
+    #Mask is both the where= and the out= of the NoData test there, so numpy works on a copy of it.
+    if asis_flags:
+        np.less(Out, 251, out = Mask)
+        if NDV is not None:
+            np.not_equal(Out, NDV, out = Mask, where = Mask)
+    elif NDV is not None:
+        np.not_equal(Out, NDV, out = Mask)
+    else:
+        np.multiply(Out, correction, out = Out)
+        return Out
+    np.multiply(Out, correction, out = Out, where = Mask)
+    return Out
+
+
+def block_buffers(rows, cols):
+    #float32 block and bool mask for correct_block, allocated once per raster and reused for every window
+    return np.empty((rows, cols), dtype = np.float32), np.empty((rows, cols), dtype = bool)
+
+
+def correct_raster(src_file, dst_file, correction, asis_flags = False, memory_budget = DEFAULT_MEMORY_BUDGET, profile = None):
+    #Writes src_file multiplied by correction to dst_file as float32, one window at a time, so
+    #memory use depends on memory_budget and not on the size of the raster.
+    #NoData pixels stay NoData. With asis_flags only values below 251 are multiplied, the
+    #values above are flags of the ASIS workspace and are kept as they are.
+    #profile sets the output format, without it an uncompressed GeoTIFF is written.
+    if profile != None and profile.get('format') == 'COG':
+        #the COG driver can only copy a finished raster, so the correction goes to a local temporary file first
+        handle, tmp_file = tempfile.mkstemp(suffix = '.tif')
+        os.close(handle)
+        try:
+            correct_raster(src_file, tmp_file, correction, asis_flags, memory_budget)
+            return write_output(tmp_file, dst_file, profile)
+        finally:
+            gdal.Unlink(tmp_file)
+
+    SourceDS = gdal.Open(src_file)
+    band = SourceDS.GetRasterBand(1)
+    NDV = band.GetNoDataValue()
+    out_NDV = DEFAULT_NDV if NDV is None else NDV
+    xsize = SourceDS.RasterXSize
+    ysize = SourceDS.RasterYSize
+
+    driver = gdal.GetDriverByName('GTiff')
+    options = creation_options(profile) if profile != None else []
+    DataSet2 = driver.Create(dst_file, xsize, ysize, 1, gdal.GDT_Float32, options)
+    DataSet2.SetGeoTransform(SourceDS.GetGeoTransform())
+    DataSet2.SetProjection(SourceDS.GetProjectionRef())
+    out_band = DataSet2.GetRasterBand(1)
+    out_band.SetNoDataValue(out_NDV)
+
+    #GDAL reads each window straight into the float32 buffer, which is corrected in place
+    rows = window_rows(band, xsize, ysize, memory_budget, 5)
+    Out, Mask = block_buffers(rows, xsize)
+    for yoff in range(0, ysize, rows):
+        win_rows = min(rows, ysize - yoff)
+        Block = band.ReadAsArray(0, yoff, xsize, win_rows, buf_obj = Out[:win_rows])
+        correct_block(Block, Mask[:win_rows], correction, NDV, asis_flags)
+        out_band.WriteArray(Block, 0, yoff)
+
+    out_band.FlushCache()
+    DataSet2 = None
+    SourceDS = None
+    finish_output(dst_file, profile)
+    return dst_file
+
+
+def native_vrt(src_file, correction):
+    #In-memory VRT of src_file with the original values and data type, and correction as scale of the band.
+    return gdal.Translate('', src_file, format = 'VRT', options = ['-a_scale', repr(float(correction)), '-a_offset', '0'])
+
+
+def stamp_scale(dst_file, correction, profile):
+    #gdal.Warp copies the scale of the source band, this makes sure of it for GeoTIFF outputs.
+    #COG outputs are read-only once written, they get the scale from the VRT they are copied from.
+    if profile.get('format') == 'COG':
+        return
+    DataSet = gdal.Open(dst_file, gdal.GA_Update)
+    band = DataSet.GetRasterBand(1)
+    if band.GetScale() != float(correction):
+        band.SetScale(float(correction))
+        band.SetOffset(0)
+    DataSet = None
+
+
+def scale_raster(src_file, dst_file, correction, profile = None):
+    #Copies src_file to dst_file with its integer values unchanged and correction stored as the scale
+    #of the band, readers that apply the scale (QGIS, rasterio, xarray) see the corrected values.
+    #A byte raster stays a quarter of the size of the float32 copy correct_raster makes.
+    if profile == None:
+        profile = output_profile()
+    vrt = native_vrt(src_file, correction)
+    write_output(vrt, dst_file, profile, vrt.GetRasterBand(1).DataType)
+    vrt = None
+    stamp_scale(dst_file, correction, profile)
+    return dst_file
+
+
+def clip_raster(src_file, dst_file, cutline, profile = None):
+    #Crops src_file to the polygons of the cutline, pixels touched by the polygons are kept.
+    if profile == None:
+        profile = output_profile()
+    gdal.Warp(dst_file, src_file, cutlineDSName = cutline, cropToCutline = (True), warpOptions = [ 'CUTLINE_ALL_TOUCHED=TRUE' ],
+              format = profile.get('format', 'GTiff'), creationOptions = creation_options(profile))
+    finish_output(dst_file, profile)
+    return dst_file
+
+
+def prepare_cutline(vector_location, dst_file, srs_wkt, tolerance = None):
+    #Copies the polygons of a QGIS layer source ('path', optionally followed by '|layername=...' or
+    #'|layerid=...') to dst_file as GeoJSON in the CRS srs_wkt, simplified to tolerance (in units of
+    #that CRS) when given. Returns None when OGR cannot open the source.
+    parts = vector_location.split('|')
+    source = ogr.Open(parts[0])
+    if source == None:
+        return None
+    layer = source.GetLayer(0)
+    for part in parts[1:]:
+        if part.startswith('layername='):
+            layer = source.GetLayerByName(part[len('layername='):])
+        elif part.startswith('layerid='):
+            layer = source.GetLayer(int(part[len('layerid='):]))
+    target = osr.SpatialReference()
+    target.ImportFromWkt(srs_wkt)
+    source_srs = layer.GetSpatialRef()
+    transform = None
+    if source_srs != None and not source_srs.IsSame(target):
+        #GDAL 3 would otherwise swap the axes of geographic coordinates
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            source_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            target.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(source_srs, target)
+
+    driver = ogr.GetDriverByName('GeoJSON')
+    if os.path.isfile(dst_file):
+        driver.DeleteDataSource(dst_file)
+    os.makedirs(os.path.dirname(os.path.abspath(dst_file)), exist_ok = True)
+    out = driver.CreateDataSource(dst_file)
+    out_layer = out.CreateLayer('cutline', target, ogr.wkbUnknown)
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if geometry == None:
+            continue
+        geometry = geometry.Clone()
+        if transform != None:
+            geometry.Transform(transform)
+        if tolerance:
+            geometry = geometry.SimplifyPreserveTopology(tolerance)
+        new_feature = ogr.Feature(out_layer.GetLayerDefn())
+        new_feature.SetGeometry(geometry)
+        out_layer.CreateFeature(new_feature)
+    out = None
+    source = None
+    return dst_file
+
+
+#rasterized cutlines of this process, by cutline file and grid, see cutline_mask
+_MASKS = dict()
+
+
+def clear_masks():
+    #forgets the rasterized cutlines, called when a run starts so they do not pile up in a long lived process
+    _MASKS.clear()
+
+
+def to_pixels(geometry, InvGeoT):
+    #Moves every point of geometry, in place, from map coordinates to pixel coordinates with the inverse
+    #geotransform InvGeoT
+    for i in range(geometry.GetGeometryCount()):
+        to_pixels(geometry.GetGeometryRef(i), InvGeoT)
+    for i in range(geometry.GetPointCount()):
+        x, y = geometry.GetX(i), geometry.GetY(i)
+        geometry.SetPoint_2D(i, InvGeoT[0] + x * InvGeoT[1] + y * InvGeoT[2], InvGeoT[3] + x * InvGeoT[4] + y * InvGeoT[5])
+
+
+def rasterize_cutline(cutline, SourceDS):
+    #Window of SourceDS around the cutline (xoff, yoff, cols, rows), its geotransform and a mask of
+    #the pixels not touched by the polygons. The cutline must be in the CRS of SourceDS.
+    xsize = SourceDS.RasterXSize
+    ysize = SourceDS.RasterYSize
+    GeoT = SourceDS.GetGeoTransform()
+    vector = ogr.Open(cutline)
+    layer = vector.GetLayer(0)
+    minx, maxx, miny, maxy = layer.GetExtent()
+    #the extent is snapped to the source pixels like gdal.Warp does with cropToCutline, an edge less than
+    #a thousandth of a pixel past a pixel boundary does not add a row or column
+    xoff = max(0, int(math.floor((minx - GeoT[0]) / GeoT[1] + 0.001)))
+    xend = min(xsize, int(math.ceil((maxx - GeoT[0]) / GeoT[1] - 0.001)))
+    yoff = max(0, int(math.floor((maxy - GeoT[3]) / GeoT[5] + 0.001)))
+    yend = min(ysize, int(math.ceil((miny - GeoT[3]) / GeoT[5] - 0.001)))
+    cols = xend - xoff
+    rows = yend - yoff
+    if cols <= 0 or rows <= 0:
+        return None
+    out_GeoT = (GeoT[0] + xoff * GeoT[1], GeoT[1], 0.0, GeoT[3] + yoff * GeoT[5], 0.0, GeoT[5])
+    #like the cutline masker of gdal.Warp the polygons are moved to source pixel coordinates and rasterized
+    #there, rasterizing in map coordinates gives other pixels where an edge runs through pixel corners
+    InvGeoT = gdal.InvGeoTransform(GeoT)
+    driver = ogr.GetDriverByName('MEM')
+    if driver == None or driver.GetMetadataItem('DCAP_VECTOR') != 'YES':
+        #GDAL before 3.11 has the vector driver under its old name
+        driver = ogr.GetDriverByName('Memory')
+    PixelDS = driver.CreateDataSource('')
+    pixel_layer = PixelDS.CreateLayer('cutline', None, ogr.wkbUnknown)
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if geometry == None:
+            continue
+        geometry = geometry.Clone()
+        to_pixels(geometry, InvGeoT)
+        pixel_feature = ogr.Feature(pixel_layer.GetLayerDefn())
+        pixel_feature.SetGeometry(geometry)
+        pixel_layer.CreateFeature(pixel_feature)
+    MaskDS = gdal.GetDriverByName('MEM').Create('', cols, rows, 1, gdal.GDT_Byte)
+    MaskDS.SetGeoTransform((xoff, 1.0, 0.0, yoff, 0.0, 1.0))
+    gdal.RasterizeLayer(MaskDS, [1], pixel_layer, burn_values = [1], options = ['ALL_TOUCHED=TRUE'])
+    outside = MaskDS.GetRasterBand(1).ReadAsArray() == 0
+    MaskDS = None
+    PixelDS = None
+    vector = None
+    return xoff, yoff, cols, rows, out_GeoT, outside
+
+
+def cutline_mask(cutline, SourceDS):
+    #rasterize_cutline, done once per grid and kept for the next rasters on the same grid. The modification
+    #time of the cutline is part of the key, so a cutline file that is written again is rasterized again.
+    key = (cutline, os.path.getmtime(cutline), SourceDS.RasterXSize, SourceDS.RasterYSize, SourceDS.GetGeoTransform())
+    if key not in _MASKS:
+        _MASKS[key] = rasterize_cutline(cutline, SourceDS)
+    return _MASKS[key]
+
+
+def clip_prepared(src_file, dst_file, cutline, correction, asis_flags = False, memory_budget = DEFAULT_MEMORY_BUDGET, profile = None):
+    #Corrects and clips src_file with the cached mask of its grid instead of gdal.Warp: reads only the
+    #window around the cutline, corrects it like correct_raster and sets the pixels outside the polygons
+    #to NoData. The window is aligned on the source pixels, so no pixel is resampled. The cutline must be
+    #prepared with prepare_cutline. Returns False, without writing, for rasters it cannot handle
+    #(rotated grids, no overlap, integer output without a NoData value).
+    if profile == None:
+        profile = output_profile()
+    SourceDS = gdal.Open(src_file)
+    GeoT = SourceDS.GetGeoTransform()
+    if GeoT[2] != 0 or GeoT[4] != 0:
+        return False
+    window = cutline_mask(cutline, SourceDS)
+    if window == None:
+        return False
+    xoff, yoff, cols, rows, out_GeoT, outside = window
+    band = SourceDS.GetRasterBand(1)
+    NDV = band.GetNoDataValue()
+    native = profile.get('native_dtype') and not asis_flags
+    if native and NDV is None:
+        return False
+    out_NDV = DEFAULT_NDV if NDV is None else NDV
+    data_type = band.DataType if native else gdal.GDT_Float32
+
+    write_file = dst_file
+    if profile.get('format') == 'COG':
+        #the COG driver can only copy a finished raster
+        handle, write_file = tempfile.mkstemp(suffix = '.tif')
+        os.close(handle)
+    options = creation_options(output_profile() if write_file != dst_file else profile, data_type)
+    DataSet2 = gdal.GetDriverByName('GTiff').Create(write_file, cols, rows, 1, data_type, options)
+    DataSet2.SetGeoTransform(out_GeoT)
+    DataSet2.SetProjection(SourceDS.GetProjectionRef())
+    out_band = DataSet2.GetRasterBand(1)
+    out_band.SetNoDataValue(out_NDV)
+    if native:
+        out_band.SetScale(float(correction))
+        out_band.SetOffset(0)
+
+    step = window_rows(band, cols, rows, memory_budget, 5)
+    if not native:
+        Out, Mask = block_buffers(step, cols)
+    for y in range(0, rows, step):
+        win_rows = min(step, rows - y)
+        if native:
+            Block = band.ReadAsArray(xoff, yoff + y, cols, win_rows)
+        else:
+            Block = band.ReadAsArray(xoff, yoff + y, cols, win_rows, buf_obj = Out[:win_rows])
+            correct_block(Block, Mask[:win_rows], correction, NDV, asis_flags)
+        #GDAL gives the NoData value as a float, copyto does not cast it to an integer block by itself
+        np.copyto(Block, Block.dtype.type(out_NDV), where = outside[y:y + win_rows])
+        out_band.WriteArray(Block, 0, y)
+    out_band.FlushCache()
+    DataSet2 = None
+    SourceDS = None
+    if write_file != dst_file:
+        try:
+            write_output(write_file, dst_file, profile, data_type)
+        finally:
+            gdal.Unlink(write_file)
+    else:
+        finish_output(dst_file, profile)
+    return True
+
+
+def process_raster(download_file, outfilename, correction, cutline = None, asis_flags = False, fused = True,
+                   temp_folder = None, memory_budget = DEFAULT_MEMORY_BUDGET, profile = None, prepared = False):
+    #All post-processing of one download: corrects (or scales) it, clips it when a cutline is given,
+    #writes outfilename and removes the download. Only takes and returns plain values, so the
+    #download worker can run it in a process pool. Returns outfilename, the manifest states the
+    #raster went through and the checksum of outfilename.
+    #With fused, a prepared cutline (see prepare_cutline) is applied with clip_prepared, without gdal.Warp.
+    if profile == None:
+        profile = output_profile()
+    filename = os.path.basename(outfilename)
+    #gdal.Warp would update an existing file instead of replacing it
+    if os.path.isfile(outfilename):
+        os.remove(outfilename)
+    #the ASIS flag values must not be scaled, so those rasters are always saved as float32
+    native = profile.get('native_dtype') and not asis_flags
+    if cutline != None and prepared and fused and clip_prepared(download_file, outfilename, cutline, correction,
+                                                                asis_flags, memory_budget, profile):
+        states = ['clipped']
+    elif native and cutline == None:
+        scale_raster(download_file, outfilename, correction, profile = profile)
+        states = ['corrected']
+    elif cutline != None and (fused or native) and not asis_flags:
+        scale_and_clip(download_file, outfilename, correction, cutline, memory_budget = memory_budget, profile = profile)
+        states = ['clipped']
+    else:
+        #When clipping, the corrected raster only lives in GDAL's memory file system (or on the
+        #local temp disk when it is larger than the memory budget) and the clip writes the final
+        #file, so the download folder is written to only once.
+        corrected_file = outfilename
+        if cutline != None and float_size(download_file) <= memory_budget:
+            corrected_file = '/vsimem/{0}/{1}'.format(os.path.basename(os.path.dirname(outfilename)), filename)
+        elif cutline != None:
+            corrected_file = os.path.join(temp_folder, filename)
+        #the output profile only applies to the file that ends up in the download folder
+        correct_raster(download_file, corrected_file, correction, asis_flags = asis_flags,
+                       memory_budget = memory_budget, profile = None if cutline != None else profile)
+        states = ['corrected']
+        if cutline != None:
+            os.remove(download_file)
+            try:
+                clip_raster(corrected_file, outfilename, cutline, profile = profile)
+            finally:
+                gdal.Unlink(corrected_file)
+            states.append('clipped')
+    if os.path.isfile(download_file):
+        os.remove(download_file)
+    return outfilename, states, file_checksum(outfilename)
+
+
+def scaled_vrt(src_file, correction):
+    #VRT description of src_file as float32 with every pixel multiplied by correction while it
+    #is read. NoData pixels of the source are not scaled and read as the NoData value.
+    SourceDS = gdal.Open(src_file)
+    band = SourceDS.GetRasterBand(1)
+    NDV = band.GetNoDataValue()
+    out_NDV = DEFAULT_NDV if NDV is None else NDV
+    xsize = SourceDS.RasterXSize
+    ysize = SourceDS.RasterYSize
+    source_nodata = '' if NDV is None else '<NODATA>{0!r}</NODATA>'.format(NDV)
+    return (
+        '<VRTDataset rasterXSize="{x}" rasterYSize="{y}">'
+        '<SRS>{srs}</SRS>'
+        '<GeoTransform>{geot}</GeoTransform>'
+        '<VRTRasterBand dataType="Float32" band="1">'
+        '<NoDataValue>{ndv!r}</NoDataValue>'
+        '<ComplexSource>'
+        '<SourceFilename relativeToVRT="0">{src}</SourceFilename>'
+        '<SourceBand>1</SourceBand>'
+        '<SrcRect xOff="0" yOff="0" xSize="{x}" ySize="{y}"/>'
+        '<DstRect xOff="0" yOff="0" xSize="{x}" ySize="{y}"/>'
+        '<ScaleOffset>0</ScaleOffset>'
+        '<ScaleRatio>{ratio!r}</ScaleRatio>'
+        '{nodata}'
+        '</ComplexSource>'
+        '</VRTRasterBand>'
+        '</VRTDataset>').format(x = xsize, y = ysize, srs = escape(SourceDS.GetProjectionRef()),
+                                geot = ', '.join(repr(v) for v in SourceDS.GetGeoTransform()),
+                                ndv = float(out_NDV), src = escape(src_file), ratio = float(correction),
+                                nodata = source_nodata)
+
+
+def scale_and_clip(src_file, dst_file, correction, cutline, memory_budget = DEFAULT_MEMORY_BUDGET, profile = None):
+    #Does the work of correct_raster followed by clip_raster in a single pass: gdal.Warp reads
+    #the download through a VRT that scales the pixels on the fly and writes only the clipped
+    #result. Does not handle the ASIS flag values, those rasters need correct_raster.
+    #With native_dtype in the profile the values are not scaled, the clip keeps the integer
+    #values and the correction is stored as the scale of the band, like scale_raster.
+    if profile == None:
+        profile = output_profile()
+    if profile.get('native_dtype'):
+        vrt = native_vrt(src_file, correction)
+    else:
+        vrt = gdal.Open(scaled_vrt(src_file, correction))
+    gdal.Warp(dst_file, vrt, cutlineDSName = cutline, cropToCutline = (True), warpOptions = [ 'CUTLINE_ALL_TOUCHED=TRUE' ],
+              warpMemoryLimit = memory_budget, format = profile.get('format', 'GTiff'),
+              creationOptions = creation_options(profile, vrt.GetRasterBand(1).DataType))
+    vrt = None
+    if profile.get('native_dtype'):
+        stamp_scale(dst_file, correction, profile)
+    finish_output(dst_file, profile)
+    return dst_file
+
+
+class TimeStack:
+    #Collects the finished rasters of one cube in a single multi-band file, band n holds row n of the
+    #availability list. Rasters are added as they arrive and in any order; the first one sets the grid
+    #and rasters on another grid are left out. A 'VRT' stack only references the files, a 'GTiff'
+    #stack copies the pixels and uses the compression and tiling of the output profile.
+    def __init__(self, dst_file, band_count, kind = 'GTiff', profile = None):
+        self.dst_file = dst_file
+        self.band_count = band_count
+        self.kind = kind
+        self.profile = profile if profile != None else output_profile()
+        self.dataset = None
+        self.grid = None
+
+    def _create(self, SourceDS):
+        band = SourceDS.GetRasterBand(1)
+        xsize = SourceDS.RasterXSize
+        ysize = SourceDS.RasterYSize
+        if os.path.isfile(self.dst_file):
+            os.remove(self.dst_file)
+        if self.kind == 'VRT':
+            self.dataset = gdal.GetDriverByName('VRT').Create(self.dst_file, xsize, ysize, self.band_count, band.DataType)
+        else:
+            #a COG cannot be written band by band, the stack uses the GeoTIFF version of the profile
+            profile = dict(self.profile, format = 'GTiff')
+            options = creation_options(profile, band.DataType) + ['INTERLEAVE=BAND']
+            self.dataset = gdal.GetDriverByName('GTiff').Create(self.dst_file, xsize, ysize, self.band_count, band.DataType, options)
+        self.dataset.SetGeoTransform(SourceDS.GetGeoTransform())
+        self.dataset.SetProjection(SourceDS.GetProjectionRef())
+        NDV = band.GetNoDataValue()
+        for i in range(self.band_count):
+            if NDV is not None:
+                self.dataset.GetRasterBand(i + 1).SetNoDataValue(NDV)
+        self.grid = (xsize, ysize, SourceDS.GetGeoTransform())
+
+    def add(self, band_number, src_file, description, metadata = None):
+        SourceDS = gdal.Open(src_file)
+        if self.dataset == None:
+            self._create(SourceDS)
+        elif (SourceDS.RasterXSize, SourceDS.RasterYSize, SourceDS.GetGeoTransform()) != self.grid:
+            print('{0} is not on the grid of {1}, it is left out of the stack'.format(src_file, self.dst_file))
+            return False
+        src_band = SourceDS.GetRasterBand(1)
+        out_band = self.dataset.GetRasterBand(band_number)
+        out_band.SetDescription(description)
+        if metadata:
+            out_band.SetMetadata(metadata)
+        if src_band.GetScale() not in (None, 1):
+            out_band.SetScale(src_band.GetScale())
+            out_band.SetOffset(src_band.GetOffset() or 0)
+        xsize, ysize = self.grid[0], self.grid[1]
+        if self.kind == 'VRT':
+            #relative to the VRT, so the folder can be moved with the stack
+            source = os.path.relpath(os.path.abspath(src_file), os.path.dirname(os.path.abspath(self.dst_file)))
+            out_band.SetMetadataItem('source_0',
+                '<SimpleSource><SourceFilename relativeToVRT="1">{0}</SourceFilename><SourceBand>1</SourceBand>'
+                '<SrcRect xOff="0" yOff="0" xSize="{1}" ySize="{2}"/><DstRect xOff="0" yOff="0" xSize="{1}" ySize="{2}"/>'
+                '</SimpleSource>'.format(escape(source.replace(os.sep, '/')), xsize, ysize), 'new_vrt_sources')
+        else:
+            rows = window_rows(src_band, xsize, ysize, DEFAULT_MEMORY_BUDGET, 8)
+            for yoff in range(0, ysize, rows):
+                out_band.WriteArray(src_band.ReadAsArray(0, yoff, xsize, min(rows, ysize - yoff)), 0, yoff)
+        self.dataset.FlushCache()
+        SourceDS = None
+        return True
+
+    def close(self):
+        if self.dataset == None:
+            return None
+        self.dataset.FlushCache()
+        self.dataset = None
+        if self.kind != 'VRT':
+            finish_output(self.dst_file, dict(self.profile, format = 'GTiff'))
+        return self.dst_file
+
+
+def datacube_available(kind):
+    #True when the package for a 'NetCDF' or 'Zarr' datacube can be imported
+    return (kind == 'NetCDF' and netCDF4 != None) or (kind == 'Zarr' and zarr != None)
+
+
+def period_start(member):
+    #Start date of a TIME/DEKAD dimension member such as '[2009-01-01,2009-01-11)', or None
+    match = re.search(r'(\d{4})-(\d{2})-(\d{2})', str(member))
+    if match == None:
+        match = re.search(r'(\d{4})', str(member))
+        return None if match == None else datetime.datetime(int(match.group(1)), 1, 1)
+    return datetime.datetime(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+
+
+class DataCube:
+    #Writes the finished rasters of one cube as a chunked, compressed NetCDF4 file or Zarr store with
+    #dimensions (time, y, x). Step n is row n of the availability list and is written as soon as its
+    #raster is saved, so only one time step is in memory at a time. Values are stored as float32 in
+    #physical units (scale applied, NoData as NaN). The first raster sets the grid.
+    EPOCH = datetime.datetime(1970, 1, 1)
+
+    def __init__(self, dst_file, step_count, kind = 'NetCDF', measure = None):
+        self.dst_file = dst_file
+        self.step_count = step_count
+        self.kind = kind
+        self.measure = measure if measure != None else dict()
+        self.store = None
+        self.grid = None
+
+    def _attributes(self):
+        #measure info of the cube catalog as attributes of the data variable
+        attributes = dict()
+        for key, value in self.measure.items():
+            if isinstance(value, (str, int, float)) and not isinstance(value, bool):
+                attributes[key] = value
+        if 'caption' in self.measure:
+            attributes['long_name'] = self.measure['caption']
+        if 'unit' in self.measure:
+            attributes['units'] = self.measure['unit']
+        return attributes
+
+    def _create(self, SourceDS):
+        xsize = SourceDS.RasterXSize
+        ysize = SourceDS.RasterYSize
+        GeoT = SourceDS.GetGeoTransform()
+        x = GeoT[0] + GeoT[1] * (np.arange(xsize) + 0.5)
+        y = GeoT[3] + GeoT[5] * (np.arange(ysize) + 0.5)
+        chunks = (1, min(ysize, 512), min(xsize, 512))
+        name = str(self.measure.get('code', 'data'))
+        if self.kind == 'NetCDF':
+            self.store = netCDF4.Dataset(self.dst_file, 'w', format = 'NETCDF4')
+            self.store.createDimension('time', None)
+            self.store.createDimension('y', ysize)
+            self.store.createDimension('x', xsize)
+            time = self.store.createVariable('time', 'f8', ('time',), fill_value = np.nan)
+            time.units = 'days since 1970-01-01'
+            time.calendar = 'standard'
+            self.store.createVariable('y', 'f8', ('y',))[:] = y
+            self.store.createVariable('x', 'f8', ('x',))[:] = x
+            crs = self.store.createVariable('spatial_ref', 'i4')
+            crs.crs_wkt = SourceDS.GetProjectionRef()
+            crs.GeoTransform = ' '.join(repr(v) for v in GeoT)
+            self.data = self.store.createVariable(name, 'f4', ('time', 'y', 'x'), zlib = True, complevel = 4,
+                                                  chunksizes = chunks, fill_value = np.float32(np.nan))
+            self.data.setncatts(self._attributes())
+            self.data.grid_mapping = 'spatial_ref'
+            self.time = time
+        else:
+            #Always a zarr 2 store, xarray finds its dimension names in the _ARRAY_DIMENSIONS attributes.
+            #zarr-python 3 writes zarr 3 by default, zarr-python 2 has no zarr_format argument.
+            try:
+                self.store = zarr.open_group(self.dst_file, mode = 'w', zarr_format = 2)
+            except TypeError:
+                self.store = zarr.open_group(self.dst_file, mode = 'w')
+            self.time = self._zarr_array('time', ['time'], shape = (self.step_count,), dtype = 'f8', fill_value = np.nan)
+            self.time.attrs.update({'units': 'days since 1970-01-01', 'calendar': 'standard'})
+            self._zarr_array('y', ['y'], shape = y.shape, dtype = 'f8')[:] = y
+            self._zarr_array('x', ['x'], shape = x.shape, dtype = 'f8')[:] = x
+            self.data = self._zarr_array(name, ['time', 'y', 'x'], shape = (self.step_count, ysize, xsize), chunks = chunks,
+                                         dtype = 'f4', fill_value = np.nan)
+            self.data.attrs.update(self._attributes())
+            self.data.attrs['crs_wkt'] = SourceDS.GetProjectionRef()
+        self.grid = (xsize, ysize, GeoT)
+
+    def _zarr_array(self, name, dimensions, **kwargs):
+        #create_array is zarr-python 3, create_dataset (deprecated there) its zarr-python 2 name
+        if hasattr(self.store, 'create_array'):
+            array = self.store.create_array(name, **kwargs)
+        else:
+            array = self.store.create_dataset(name, **kwargs)
+        array.attrs['_ARRAY_DIMENSIONS'] = dimensions
+        return array
+
+    def add(self, step, src_file, time = None):
+        #step counts from 0, time is a datetime or None when the cube has no time dimension
+        SourceDS = gdal.Open(src_file)
+        if self.store == None:
+            self._create(SourceDS)
+        elif (SourceDS.RasterXSize, SourceDS.RasterYSize, SourceDS.GetGeoTransform()) != self.grid:
+            print('{0} is not on the grid of {1}, it is left out of the datacube'.format(src_file, self.dst_file))
+            return False
+        SourceDS = None
+        self.data[step, :, :] = read_physical(src_file)
+        self.time[step] = np.nan if time == None else (time - self.EPOCH).total_seconds() / 86400
+        return True
+
+    def close(self):
+        if self.store == None:
+            return None
+        if self.kind == 'NetCDF':
+            self.store.close()
+        self.store = None
+        return self.dst_file
@@ -0,0 +1,122 @@
+# coding=utf-8
+"""Benchmark of the availability table parser.
+
+Compares the parsing getAvailData did before (the items wrapped in a
+DataFrame and walked with iterrows) with parse_avail_items on a synthetic
+MDAQuery_Table response of 10,000 rows, shaped like a dekadal cube with a
+second WHAT dimension. Run from the plugin folder:
+
+    python test/bench_avail_parser.py
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'BVissers929@gmail.com'
+__date__ = '2023-03-14'
+__copyright__ = 'Copyright 2023, Brenden Vissers / Celray James Chawanda'
+
+import datetime
+import os
+import sys
+import timeit
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from FAO_Downloader_query import index_members, parse_avail_items
+
+ROWS = 10000
+REPEAT = 5
+
+
+def synthetic_response(rows):
+    """Items and dimension members of a table with a DEKAD and a LCC dimension."""
+    start = datetime.date(2009, 1, 1)
+    dekads = []
+    for d in range(rows // 10):
+        first = start + datetime.timedelta(days = 10 * d)
+        dekads.append({'code': '[{0},{1})'.format(first, first + datetime.timedelta(days = 10)),
+                       'caption': 'Dekad {0}'.format(d), 'description': 'Dekad starting {0}'.format(first)})
+    classes = [{'code': 'C{0}'.format(c), 'caption': 'Class {0}'.format(c)} for c in range(10)]
+    items = []
+    for d in dekads:
+        for c in classes:
+            raster_id = 'L2_AETI_{0}_{1}'.format(d['caption'], c['code'])
+            items.append([{'type': 'ROW_HEADER', 'value': d['caption']},
+                          {'type': 'ROW_HEADER', 'value': c['caption']},
+                          {'type': 'DATA_CELL', 'value': 1,
+                           'metadata': {'raster': {'id': raster_id, 'bbox': [{'srid': 'EPSG:4326', 'value': [30, 0, 31, 1]}]}}}])
+    return items, dekads, classes
+
+
+def legacy(items, rows_codes, dims):
+    """The parsing of getAvailData before parse_avail_items."""
+    df = pd.DataFrame(items)
+    df_dims_ls = []
+    for code in rows_codes:
+        df_dims_ls = df_dims_ls + dims[code]
+    keys = []
+    for item in rows_codes:
+        keys.append(item)
+        keys.append(item + '-code')
+        keys.append(item + '-description')
+    keys = keys + ['raster_id', 'bbox']
+    df_dict = {i: [] for i in keys}
+    for irow, row in df.iterrows():
+        header_count = 0
+        cell_count = 0
+        for i in range(len(row)):
+            if row[i] == None:
+                break
+            if row[i]['type'] == 'ROW_HEADER':
+                key_info = row[i]['value']
+                header_number = int(header_count * 3)
+                df_dict[keys[header_number]].append(key_info)
+                for j in df_dims_ls:
+                    if j['caption'] == key_info:
+                        key = keys[header_number] + '-code'
+                        df_dict[key].append(j['code'])
+                        key = keys[header_number] + '-description'
+                        try:
+                            df_dict[key].append(j['description'])
+                        except:
+                            df_dict[key].append('NA')
+                        header_count += 1
+                        break
+            if row[i]['type'] == 'DATA_CELL':
+                if cell_count != 0:
+                    k = 0
+                    while k < len(df_dict) - 2:
+                        key = keys[k]
+                        df_dict[key].append(df_dict[key][-1])
+                        k += 1
+                raster_info = row[i]['metadata']['raster']
+                df_dict['raster_id'].append(raster_info['id'])
+                df_dict['bbox'].append(raster_info['bbox'])
+                cell_count += 1
+    return pd.DataFrame.from_dict(df_dict)
+
+
+def columnar(items, rows_codes, dims):
+    members = {code: index_members(dims[code]) for code in rows_codes}
+    return pd.DataFrame.from_dict(parse_avail_items(items, rows_codes, members))
+
+
+def main():
+    items, dekads, classes = synthetic_response(ROWS)
+    rows_codes = ['DEKAD', 'LCC']
+    dims = {'DEKAD': dekads, 'LCC': classes}
+    pd.testing.assert_frame_equal(legacy(items, rows_codes, dims), columnar(items, rows_codes, dims))
+    old_time = min(timeit.repeat(lambda: legacy(items, rows_codes, dims), number = 1, repeat = REPEAT))
+    new_time = min(timeit.repeat(lambda: columnar(items, rows_codes, dims), number = 1, repeat = REPEAT))
+    print('{0} row synthetic MDAQuery_Table response'.format(len(items)))
+    print('  iterrows          {0:8.1f} ms'.format(old_time * 1000))
+    print('  parse_avail_items {0:8.1f} ms'.format(new_time * 1000))
+
+
+if __name__ == "__main__":
+    main()
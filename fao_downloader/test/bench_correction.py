@@ -0,0 +1,97 @@
+# coding=utf-8
+"""Micro-benchmark of the raster correction kernel.
+
+Compares the correction as it was done before (OpenAsArray with nan_values,
+the multiplication of Tiff_Edit_Save and the NoData conversions of
+CreateGeoTiff) with correct_block, which reads into a preallocated float32
+buffer and corrects it in place. Prints the time and the peak memory
+allocated per raster. Run from the plugin folder:
+
+    python test/bench_correction.py
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'BVissers929@gmail.com'
+__date__ = '2023-03-14'
+__copyright__ = 'Copyright 2023, Brenden Vissers / Celray James Chawanda'
+
+import os
+import sys
+import timeit
+import tracemalloc
+import warnings
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from FAO_Downloader_raster import block_buffers, correct_block
+
+NDV = -9999
+CORRECTION = 0.1
+REPEAT = 20
+
+
+def legacy(raw, asis_flags):
+    """The correction before correct_block, the statements of OpenAsArray(nan_values = True),
+    Tiff_Edit_Save and CreateGeoTiff as they were. raw.copy() stands in for ReadAsArray, which
+    returned a new array. Returns the array as CreateGeoTiff left it, with NaN for NoData."""
+    #OpenAsArray
+    Array = raw.copy().astype(np.float32)
+    Array[Array  == NDV] = np.nan
+    #Tiff_Edit_Save
+    if asis_flags:
+        CorrectedArray = np.multiply(Array, CORRECTION, out = Array, where = Array < 251)
+    else:
+        CorrectedArray = np.multiply(Array, CORRECTION, where = Array!=NDV)
+    #CreateGeoTiff, the array is written between these two statements
+    CorrectedArray[np.isnan(CorrectedArray)] = NDV
+    if "nt" not in CorrectedArray.dtype.name:
+        CorrectedArray[CorrectedArray  == NDV] = np.nan
+    return CorrectedArray
+
+
+def written(Array):
+    """The values legacy wrote to the GeoTIFF, NoData instead of NaN."""
+    return np.where(np.isnan(Array), NDV, Array)
+
+
+def in_place(raw, asis_flags, Out, Mask):
+    """correct_block, np.copyto stands in for GDAL reading into the buffer."""
+    np.copyto(Out, raw)
+    return correct_block(Out, Mask, CORRECTION, NDV, asis_flags)
+
+
+def peak_bytes(function):
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    #the multiplication of the old kernel is kept as it was, newer numpy warns about it
+    warnings.filterwarnings('ignore', message = "'where' used without 'out'")
+    rows, cols = 2000, 2000
+    raw = (np.arange(rows * cols, dtype = np.int16) % 300).reshape(rows, cols)
+    raw[::7, ::5] = NDV
+    Out, Mask = block_buffers(rows, cols)
+
+    for asis_flags in (False, True):
+        np.testing.assert_array_equal(written(legacy(raw, asis_flags)), in_place(raw, asis_flags, Out, Mask))
+        old_time = min(timeit.repeat(lambda: legacy(raw, asis_flags), number = 1, repeat = REPEAT))
+        new_time = min(timeit.repeat(lambda: in_place(raw, asis_flags, Out, Mask), number = 1, repeat = REPEAT))
+        old_peak = peak_bytes(lambda: legacy(raw, asis_flags))
+        new_peak = peak_bytes(lambda: in_place(raw, asis_flags, Out, Mask))
+        print('{0}x{1} int16 raster, asis_flags={2}'.format(rows, cols, asis_flags))
+        print('  legacy        {0:8.2f} ms  {1:8.1f} MB allocated'.format(old_time * 1000, old_peak / 1048576))
+        print('  correct_block {0:8.2f} ms  {1:8.1f} MB allocated'.format(new_time * 1000, new_peak / 1048576))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+# coding=utf-8
+"""FAO API connection test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'BVissers929@gmail.com'
+__date__ = '2023-03-14'
+__copyright__ = 'Copyright 2023, Brenden Vissers / Celray James Chawanda'
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import requests
+
+from FAO_Downloader_http import CatalogCache, DownloadEngine, JobPoller
+
+
+class Clock:
+    """Stands in for the time module of FAO_Downloader_http."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+
+class Server:
+    """Answers job checks from a dict of job url -> status and records every check."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.status = dict()
+        self.checks = []
+
+    def check(self, job_url):
+        self.checks.append((job_url, self.clock.now))
+        status = self.status.get(job_url, 'RUNNING')
+        if status == 'ERROR':
+            raise IOError('connection reset')
+        return status, 'https://download/' + job_url if status == 'COMPLETED' else None
+
+
+class Session:
+    """Answers gets from a dict of url -> (status code, JSON body), other urls cannot be reached.
+
+    The urls in files are downloads. A Range request is answered with range_status: 206 with the
+    rest of the file, 416 or 200 with the whole file. The last truncate bytes of a body are not sent.
+    """
+
+    def __init__(self):
+        self.answers = dict()
+        self.files = dict()
+        self.range_status = 206
+        self.truncate = 0
+        self.gets = []
+        self.headers = []
+
+    def get(self, url, headers = None, stream = False):
+        self.gets.append(url)
+        self.headers.append(dict(headers or {}))
+        if url in self.files:
+            return self.download(url, headers or {})
+        if url not in self.answers:
+            raise requests.ConnectionError('cannot reach ' + url)
+        status_code, body = self.answers[url]
+        resp = requests.Response()
+        resp.status_code = status_code
+        resp.url = url
+        resp._content = json.dumps(body).encode('utf-8')
+        return resp
+
+    def download(self, url, headers):
+        content = self.files[url]
+        status_code = 200
+        if 'Range' in headers and self.range_status != 200:
+            status_code = self.range_status
+            start = int(headers['Range'][len('bytes='):-1])
+            content = content[start:] if status_code == 206 else b''
+        resp = requests.Response()
+        resp.status_code = status_code
+        resp.url = url
+        resp.headers['Content-Length'] = str(len(content))
+        resp.raw = io.BytesIO(content[:len(content) - self.truncate])
+        return resp
+
+
+class FAODownloaderHttpTest(unittest.TestCase):
+    """Test the scheduling of the job poller and the catalog cache."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.clock = Clock()
+        self.server = Server(self.clock)
+        self.session = Session()
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        patcher = mock.patch('FAO_Downloader_http.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def poller(self, **kwargs):
+        poller = JobPoller(self.server.check, jitter = 0, **kwargs)
+        self.addCleanup(poller.shutdown)
+        return poller
+
+    def cache(self):
+        cache = CatalogCache(self.folder, ttl = 100)
+        cache.session = self.session
+        return cache
+
+    def engine(self):
+        engine = DownloadEngine(max_workers = 2, chunk_size = 64)
+        engine.session = self.session
+        self.addCleanup(engine.shutdown)
+        return engine
+
+    def download(self, part = None):
+        """Serves a raster of 1000 bytes, with part written to its .part file first."""
+        content = bytes(range(250)) * 4
+        self.session.files['https://download/a.tif'] = content
+        download_file = os.path.join(self.folder, 'a.tif')
+        if part != None:
+            with open(download_file + '.part', 'wb') as g:
+                g.write(part)
+        return content, download_file
+
+    def read(self, path):
+        with open(path, 'rb') as g:
+            return g.read()
+
+    def run_until(self, poller, end):
+        """Ticks at every moment a job is due until end, returns what finished."""
+        finished = []
+        while len(poller) and self.clock.now + poller.next_due() <= end:
+            self.clock.now += poller.next_due()
+            finished += poller.tick()
+        return finished
+
+    def test_backoff(self):
+        """Test the delay doubles after each check up to max_interval."""
+        poller = self.poller(first_interval = 1, max_interval = 8)
+        poller.add('a')
+        self.assertEqual(poller.tick(), [])
+        self.assertEqual(self.server.checks, [])
+        self.run_until(poller, 40)
+        self.assertEqual([t for url, t in self.server.checks], [1, 3, 7, 15, 23, 31, 39])
+
+    def test_batched_tick(self):
+        """Test all due jobs are checked in one tick and only the finished ones are returned."""
+        poller = self.poller()
+        self.server.status.update({'a': 'COMPLETED', 'c': 'FAILED'})
+        for job_url in 'abc':
+            poller.add(job_url, job_url.upper())
+        self.clock.now = 1
+        finished = poller.tick()
+        self.assertEqual(sorted(url for url, t in self.server.checks), ['a', 'b', 'c'])
+        self.assertEqual(sorted(finished), [('a', 'A', 'COMPLETED', 'https://download/a'), ('c', 'C', 'FAILED', None)])
+        self.assertEqual(len(poller), 1)
+
+    def test_latency(self):
+        """Test checks that are unlikely to succeed are skipped once jobs have finished."""
+        poller = self.poller(max_interval = 30)
+        poller.add('a')
+        self.clock.now = 15
+        self.server.status['a'] = 'COMPLETED'
+        poller.tick()
+        self.assertEqual(poller.latency, 15)
+
+        #a new job is first checked when it is expected to be done, not after first_interval
+        poller.add('b')
+        self.assertEqual(poller.next_due(), 15)
+        self.server.status['b'] = 'COMPLETED'
+        self.run_until(poller, 60)
+        self.assertEqual(self.server.checks[-1], ('b', 30))
+        #failed jobs do not count, finished ones are averaged
+        self.assertEqual(poller.latency, 15)
+        poller.add('c')
+        self.server.status['c'] = 'FAILED'
+        self.run_until(poller, 100)
+        self.assertEqual(poller.latency, 15)
+
+    def test_deadline(self):
+        """Test a job still running after the deadline is given up on."""
+        poller = self.poller(deadline = 10)
+        poller.add('a', 'tag')
+        finished = self.run_until(poller, 100)
+        self.assertEqual(finished, [('a', 'tag', 'TIMEOUT', None)])
+        self.assertEqual(len(poller), 0)
+        self.assertIsNone(poller.next_due())
+
+    def test_check_error(self):
+        """Test a job whose check fails keeps being polled."""
+        poller = self.poller()
+        poller.add('a')
+        self.server.status['a'] = 'ERROR'
+        self.clock.now = 1
+        self.assertEqual(poller.tick(), [])
+        self.assertEqual(len(poller), 1)
+        self.server.status['a'] = 'COMPLETED'
+        self.assertEqual(self.run_until(poller, 10), [('a', None, 'COMPLETED', 'https://download/a')])
+
+    def test_catalog_cache(self):
+        """Test fresh copies are used as they are and stale ones when the server cannot be reached."""
+        cache = self.cache()
+        self.session.answers['a'] = (200, {'status': 200, 'response': ['L1_AETI_D']})
+        self.assertEqual(cache.get('a')['response'], ['L1_AETI_D'])
+        self.session.answers['a'] = (200, {'status': 200, 'response': ['L1_AETI_D', 'L1_NPP_D']})
+        self.assertEqual(cache.get('a')['response'], ['L1_AETI_D'])
+        self.assertEqual(len(self.session.gets), 1)
+
+        self.clock.now = 200
+        self.assertEqual(cache.get('a')['response'], ['L1_AETI_D', 'L1_NPP_D'])
+        self.clock.now = 400
+        del self.session.answers['a']
+        self.assertEqual(cache.get('a')['response'], ['L1_AETI_D', 'L1_NPP_D'])
+        self.assertRaises(requests.ConnectionError, cache.get, 'b')
+
+    def test_get_all_errors(self):
+        """Test a url that fails only fails itself and the message of the API is kept."""
+        cache = self.cache()
+        self.session.answers['a'] = (200, {'status': 200, 'response': [{'code': 'L1_AETI_D'}]})
+        self.session.answers['b'] = (404, {'status': 404, 'message': 'Cube L1_XX_D not found'})
+        self.session.answers['c'] = (502, {})
+        results = cache.get_all(['a', 'b', 'c', 'd'])
+        self.assertEqual(results[0]['response'], [{'code': 'L1_AETI_D'}])
+        self.assertEqual(results[1], {'status': 404, 'message': 'Cube L1_XX_D not found'})
+        self.assertEqual(results[2]['status'], 502)
+        self.assertIsNone(results[3]['status'])
+        self.assertIn('cannot reach d', results[3]['message'])
+        #error answers are not kept in the cache
+        self.assertIsNone(cache.cached('b'))
+
+    def test_fetch(self):
+        """Test a download is written through a .part file that is renamed when it is complete."""
+        content, download_file = self.download()
+        engine = self.engine()
+        self.assertEqual(engine.submit('https://download/a.tif', download_file).result(), download_file)
+        self.assertEqual(self.read(download_file), content)
+        self.assertFalse(os.path.isfile(download_file + '.part'))
+        self.assertNotIn('Range', self.session.headers[-1])
+        self.assertEqual(engine.bytes_received, 1000)
+
+    def test_fetch_short_body(self):
+        """Test a body shorter than its Content-Length fails and its .part file is removed."""
+        content, download_file = self.download()
+        self.session.truncate = 10
+        future = self.engine().submit('https://download/a.tif', download_file)
+        self.assertRaises(IOError, future.result)
+        self.assertFalse(os.path.isfile(download_file + '.part'))
+        self.assertFalse(os.path.isfile(download_file))
+
+    def test_fetch_resume(self):
+        """Test a .part file of an earlier run is continued with a Range request."""
+        content, download_file = self.download(part = bytes(range(250)) * 2)
+        engine = self.engine()
+        engine.submit('https://download/a.tif', download_file).result()
+        self.assertEqual(self.session.headers[-1]['Range'], 'bytes=500-')
+        self.assertEqual(self.read(download_file), content)
+        self.assertEqual(engine.bytes_received, 500)
+
+    def test_fetch_range_not_satisfiable(self):
+        """Test a 416 answer restarts the download from the beginning."""
+        content, download_file = self.download(part = b'x' * 2000)
+        self.session.range_status = 416
+        self.engine().submit('https://download/a.tif', download_file).result()
+        self.assertEqual(len(self.session.gets), 2)
+        self.assertEqual(self.session.headers[0]['Range'], 'bytes=2000-')
+        self.assertNotIn('Range', self.session.headers[1])
+        self.assertEqual(self.read(download_file), content)
+
+    def test_fetch_range_ignored(self):
+        """Test a 200 answer to a Range request replaces the .part file instead of being appended to it."""
+        content, download_file = self.download(part = b'x' * 500)
+        self.session.range_status = 200
+        self.engine().submit('https://download/a.tif', download_file).result()
+        self.assertEqual(self.session.headers[-1]['Range'], 'bytes=500-')
+        self.assertEqual(self.read(download_file), content)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(FAODownloaderHttpTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,123 @@
+# coding=utf-8
+"""Catalog and query response parsing test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'BVissers929@gmail.com'
+__date__ = '2023-03-14'
+__copyright__ = 'Copyright 2023, Brenden Vissers / Celray James Chawanda'
+
+import datetime
+import unittest
+
+from FAO_Downloader_query import avail_keys, Catalog, index_members, parse_avail_items, raster_tasks, remove_duplicate_cells
+
+
+def header(caption):
+    return {'type': 'ROW_HEADER', 'value': caption}
+
+
+def cell(raster_id):
+    return {'type': 'DATA_CELL', 'value': 1,
+            'metadata': {'raster': {'id': raster_id, 'bbox': [{'srid': 'EPSG:4326', 'value': [30, 0, 31, 1]}]}}}
+
+
+DEKADS = [{'code': '[2009-01-01,2009-01-11)', 'caption': 'Jan 2009 D1', 'description': 'First dekad'},
+          {'code': '[2009-01-11,2009-01-21)', 'caption': 'Jan 2009 D2'}]
+SEASONS = [{'code': 'S1', 'caption': 'Season 1', 'description': 'Main season'},
+           {'code': 'S2', 'caption': 'Jan 2009 D1', 'description': 'Caption shared with a dekad'}]
+
+
+class FAODownloaderQueryTest(unittest.TestCase):
+    """Test the parsing of the availability table."""
+
+    def test_index_members_first_wins(self):
+        """Test a repeated caption keeps the first member."""
+        index = index_members(DEKADS + [{'code': 'other', 'caption': 'Jan 2009 D1'}])
+        self.assertEqual(index['Jan 2009 D1']['code'], '[2009-01-01,2009-01-11)')
+
+    def test_parse_avail_items(self):
+        """Test rows, repeated data cells, missing descriptions and padding."""
+        members = {'DEKAD': index_members(DEKADS), 'SEASON': index_members(SEASONS)}
+        items = [[header('Jan 2009 D1'), header('Season 1'), cell('L1_AETI_0901')],
+                 [header('Jan 2009 D2'), header('Jan 2009 D1'), cell('L1_AETI_0902'), cell('L1_AETI_0902b')],
+                 [header('Jan 2009 D2'), None, None]]
+        columns = parse_avail_items(items, ['DEKAD', 'SEASON'], members)
+
+        self.assertEqual(list(columns), avail_keys(['DEKAD', 'SEASON']))
+        self.assertEqual(columns['raster_id'], ['L1_AETI_0901', 'L1_AETI_0902', 'L1_AETI_0902b'])
+        self.assertEqual(columns['DEKAD-code'], ['[2009-01-01,2009-01-11)', '[2009-01-11,2009-01-21)',
+                                                 '[2009-01-11,2009-01-21)', '[2009-01-11,2009-01-21)'])
+        self.assertEqual(columns['DEKAD-description'][1], 'NA')
+        #the caption is looked up in the SEASON members only
+        self.assertEqual(columns['SEASON-code'], ['S1', 'S2', 'S2'])
+        self.assertEqual(columns['SEASON-description'][2], 'Caption shared with a dekad')
+
+    def test_remove_duplicate_cells(self):
+        """Test the dedup matches the list.remove loop it replaces."""
+        def legacy(item):
+            item = list(item)
+            y = len(item) - 1
+            while y > 0:
+                if item[y] in item[:y]:
+                    item.remove(item[y])
+                    if y > len(item) - 1:
+                        y -= 1
+                else:
+                    y -= 1
+            return item
+
+        rows = [[header('A'), cell('1'), header('A'), cell('1'), cell('2')],
+                [header('A'), header('A'), cell('1')],
+                [cell('1'), cell('2'), cell('1'), cell('3'), cell('2')]]
+        self.assertEqual(remove_duplicate_cells(rows, 'WAPOR_2', 'L1_AETI_D'), [legacy(row) for row in rows])
+        self.assertEqual(remove_duplicate_cells(rows, 'WAPOR_2', 'EMS'), rows)
+        self.assertEqual(remove_duplicate_cells(rows, 'GLEAM3', 'E'), rows)
+
+    def test_raster_tasks(self):
+        """Test the task records carry what the download stages need."""
+        members = {'DEKAD': index_members(DEKADS), 'SEASON': index_members(SEASONS)}
+        items = [[header('Jan 2009 D1'), header('Season 1'), cell('L1_AETI_0901')],
+                 [header('Jan 2009 D2'), header('Jan 2009 D1'), cell('L1_AETI_0902')]]
+        columns = parse_avail_items(items, ['DEKAD', 'SEASON'], members)
+        tasks = raster_tasks('L1_AETI_D', columns, 'DEKAD')
+
+        self.assertEqual([task.index for task in tasks], [0, 1])
+        self.assertEqual(tasks[1].raster_id, 'L1_AETI_0902')
+        self.assertEqual(tasks[1].time_code, '[2009-01-11,2009-01-21)')
+        self.assertEqual(tasks[1].interval(), (datetime.datetime(2009, 1, 11), datetime.datetime(2009, 1, 21)))
+        self.assertEqual(tasks[0].dimension_params(), [{'code': 'DEKAD', 'values': ['[2009-01-01,2009-01-11)']},
+                                                       {'code': 'SEASON', 'values': ['S1']}])
+        self.assertEqual(tasks[0].metadata()['SEASON-description'], 'Main season')
+        self.assertIsNone(raster_tasks('L1_AETI_D', columns)[0].interval())
+
+    def test_catalog(self):
+        """Test cubes are found by code, level and location."""
+        def cube(code, extent = None):
+            return {'code': code, 'caption': code, 'additionalInfo': {'spatialExtent': extent}}
+        L1 = [cube('L1_AETI_D', 'Africa')]
+        L3 = [cube('L3_AWA_AETI_D', 'Awash, Ethiopia'), cube('L3_KOG_AETI_D', 'Koga, Ethiopia'),
+              cube('L3_AWA_NPP_D', 'Awash, Ethiopia')]
+        catalog = Catalog([('L1', L1), ('L3', L3)])
+
+        self.assertEqual(len(catalog), 4)
+        self.assertIs(catalog.get('L3_KOG_AETI_D'), L3[1])
+        self.assertIsNone(catalog.get('L2_AETI_D'))
+        self.assertIn('L1_AETI_D', catalog)
+        self.assertEqual(list(catalog), L1 + L3)
+        self.assertEqual(catalog.level('L3'), L3)
+        self.assertEqual(catalog.level('L2'), [])
+        self.assertEqual(list(catalog.by_extent('L3')), ['Awash, Ethiopia', 'Koga, Ethiopia'])
+        self.assertEqual(catalog.by_extent('L3')['Awash, Ethiopia'], [L3[0], L3[2]])
+        self.assertEqual(Catalog([(None, [{'code': 5, 'caption': 'five'}])]).get('5')['caption'], 'five')
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(FAODownloaderQueryTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
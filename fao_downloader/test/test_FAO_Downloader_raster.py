@@ -0,0 +1,333 @@
+# coding=utf-8
+"""Raster post-processing test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'BVissers929@gmail.com'
+__date__ = '2023-03-14'
+__copyright__ = 'Copyright 2023, Brenden Vissers / Celray James Chawanda'
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+from osgeo import gdal, osr
+
+from FAO_Downloader_raster import (clip_prepared, clip_raster, correct_raster, DataCube, datacube_available,
+                                   file_checksum, output_profile, period_start, prepare_cutline, process_raster,
+                                   read_physical, RunManifest, scale_and_clip, scale_raster, TimeStack)
+
+
+def make_raster(path, array, ndv, block_rows = 4):
+    """Writes array as a single band GeoTIFF in EPSG:4326."""
+    types = {np.dtype('uint8'): gdal.GDT_Byte, np.dtype('int16'): gdal.GDT_Int16,
+             np.dtype('float32'): gdal.GDT_Float32}
+    ysize, xsize = array.shape
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(path, xsize, ysize, 1, types[array.dtype],
+                            ['BLOCKYSIZE={0}'.format(block_rows)])
+    dataset.SetGeoTransform([30.0, 0.01, 0, 10.0, 0, -0.01])
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    dataset.SetProjection(srs.ExportToWkt())
+    dataset.GetRasterBand(1).SetNoDataValue(ndv)
+    dataset.GetRasterBand(1).WriteArray(array)
+    dataset = None
+
+
+def read_raster(path):
+    dataset = gdal.Open(path)
+    band = dataset.GetRasterBand(1)
+    return band.ReadAsArray(), band.GetNoDataValue()
+
+
+def make_cutline(path):
+    """Writes a polygon inside the test raster as GeoJSON."""
+    with open(path, 'w') as g:
+        g.write('{"type": "FeatureCollection", "features": [{"type": "Feature", "properties": {}, '
+                '"geometry": {"type": "Polygon", "coordinates": [[[30.05, 9.6], [30.3, 9.65], '
+                '[30.2, 9.95], [30.07, 9.9], [30.05, 9.6]]]}}]}')
+
+
+class FAODownloaderRasterTest(unittest.TestCase):
+    """Test the raster correction."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.folder = tempfile.mkdtemp()
+        self.src = os.path.join(self.folder, 'raw_test.tif')
+        self.dst = os.path.join(self.folder, 'test.tif')
+        array = np.arange(50 * 37, dtype = np.int16).reshape(50, 37) % 300
+        array[::7, ::5] = -9999
+        self.array = array
+        make_raster(self.src, array, -9999)
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.folder)
+
+    def test_correct_raster(self):
+        """Test values are multiplied and NoData is kept."""
+        correct_raster(self.src, self.dst, 0.1)
+        result, ndv = read_raster(self.dst)
+        self.assertEqual(ndv, -9999)
+        expected = self.array.astype(np.float32) * np.float32(0.1)
+        expected[self.array == -9999] = -9999
+        np.testing.assert_allclose(result, expected, rtol = 1e-6)
+
+    def test_correct_raster_windows(self):
+        """Test a tiny memory budget gives the same result as one window."""
+        correct_raster(self.src, self.dst, 0.1)
+        whole, ndv = read_raster(self.dst)
+        windowed_dst = os.path.join(self.folder, 'windowed.tif')
+        correct_raster(self.src, windowed_dst, 0.1, memory_budget = 1)
+        windowed, ndv = read_raster(windowed_dst)
+        np.testing.assert_array_equal(whole, windowed)
+
+    def test_correct_raster_asis_flags(self):
+        """Test ASIS flag values are not multiplied."""
+        correct_raster(self.src, self.dst, 0.5, asis_flags = True)
+        result, ndv = read_raster(self.dst)
+        flags = (self.array >= 251) & (self.array != -9999)
+        np.testing.assert_array_equal(result[flags], self.array[flags])
+
+    def test_scale_and_clip_matches_two_steps(self):
+        """Test the one pass scale and clip equals correcting and then clipping."""
+        cutline = os.path.join(self.folder, 'cutline.geojson')
+        make_cutline(cutline)
+        corrected = os.path.join(self.folder, 'corrected.tif')
+        two_steps = os.path.join(self.folder, 'two_steps.tif')
+        one_pass = os.path.join(self.folder, 'one_pass.tif')
+        correct_raster(self.src, corrected, 0.1)
+        clip_raster(corrected, two_steps, cutline)
+        scale_and_clip(self.src, one_pass, 0.1, cutline)
+
+        expected, expected_ndv = read_raster(two_steps)
+        result, ndv = read_raster(one_pass)
+        self.assertEqual(ndv, expected_ndv)
+        self.assertEqual(gdal.Open(one_pass).GetGeoTransform(), gdal.Open(two_steps).GetGeoTransform())
+        np.testing.assert_array_equal(result == ndv, expected == expected_ndv)
+        np.testing.assert_allclose(result, expected, rtol = 1e-6)
+
+    def test_output_profile(self):
+        """Test the clip writes a compressed, tiled raster with the same values."""
+        cutline = os.path.join(self.folder, 'cutline.geojson')
+        make_cutline(cutline)
+        corrected = os.path.join(self.folder, 'corrected.tif')
+        plain = os.path.join(self.folder, 'plain.tif')
+        packed = os.path.join(self.folder, 'packed.tif')
+        correct_raster(self.src, corrected, 0.1)
+        clip_raster(corrected, plain, cutline)
+        clip_raster(corrected, packed, cutline,
+                    profile = output_profile(compress = 'DEFLATE', predictor = True, tiled = True))
+
+        dataset = gdal.Open(packed)
+        self.assertEqual(dataset.GetMetadata('IMAGE_STRUCTURE').get('COMPRESSION'), 'DEFLATE')
+        self.assertEqual(dataset.GetRasterBand(1).GetBlockSize(), [512, 512])
+        np.testing.assert_array_equal(read_raster(packed)[0], read_raster(plain)[0])
+
+    def test_scale_raster_native(self):
+        """Test the integer values are kept and read back in physical units."""
+        scale_raster(self.src, self.dst, 0.1)
+        dataset = gdal.Open(self.dst)
+        band = dataset.GetRasterBand(1)
+        self.assertEqual(band.DataType, gdal.GDT_Int16)
+        self.assertAlmostEqual(band.GetScale(), 0.1)
+        self.assertEqual(band.GetNoDataValue(), -9999)
+        np.testing.assert_array_equal(band.ReadAsArray(), self.array)
+        dataset = None
+
+        corrected = os.path.join(self.folder, 'corrected.tif')
+        correct_raster(self.src, corrected, 0.1)
+        expected, ndv = read_raster(corrected)
+        expected[expected == ndv] = np.nan
+        np.testing.assert_allclose(read_physical(self.dst), expected, rtol = 1e-6)
+
+    def test_time_stack(self):
+        """Test rasters added out of order end up in their own band."""
+        second = os.path.join(self.folder, 'second.tif')
+        make_raster(second, self.array * 2, -9999)
+        for kind, name in (('GTiff', 'stack.tif'), ('VRT', 'stack.vrt')):
+            stack = TimeStack(os.path.join(self.folder, name), 2, kind)
+            self.assertTrue(stack.add(2, second, 'second', {'DEKAD': '2009-01-11'}))
+            self.assertTrue(stack.add(1, self.src, 'first'))
+            dataset = gdal.Open(stack.close())
+            self.assertEqual(dataset.RasterCount, 2)
+            self.assertEqual(dataset.GetRasterBand(2).GetDescription(), 'second')
+            self.assertEqual(dataset.GetRasterBand(2).GetMetadataItem('DEKAD'), '2009-01-11')
+            np.testing.assert_array_equal(dataset.GetRasterBand(1).ReadAsArray(), self.array)
+            np.testing.assert_array_equal(dataset.GetRasterBand(2).ReadAsArray(), self.array * 2)
+            dataset = None
+
+    def test_period_start(self):
+        """Test the time coordinate is taken from the TIME member code."""
+        self.assertEqual(period_start('[2009-01-11,2009-01-21)'), datetime.datetime(2009, 1, 11))
+        self.assertEqual(period_start('2015'), datetime.datetime(2015, 1, 1))
+        self.assertIsNone(period_start('NA'))
+
+    @unittest.skipUnless(datacube_available('NetCDF'), 'netCDF4 is not installed')
+    def test_datacube_netcdf(self):
+        """Test each step is written at its own time with the measure attributes."""
+        import netCDF4
+        path = os.path.join(self.folder, 'cube.nc')
+        cube = DataCube(path, 2, 'NetCDF', {'code': 'AETI', 'caption': 'Evapotranspiration', 'unit': 'mm/day'})
+        cube.add(1, self.src, datetime.datetime(2009, 1, 11))
+        cube.add(0, self.src, datetime.datetime(2009, 1, 1))
+        cube.close()
+        with netCDF4.Dataset(path) as dataset:
+            self.assertEqual(dataset['AETI'].units, 'mm/day')
+            self.assertEqual(dataset['AETI'].shape, (2, 50, 37))
+            np.testing.assert_array_equal(dataset['time'][:], [14245, 14255])
+            np.testing.assert_array_equal(dataset['AETI'][1].filled(np.nan), read_physical(self.src))
+
+    @unittest.skipUnless(datacube_available('Zarr'), 'zarr is not installed')
+    def test_datacube_zarr(self):
+        """Test the store is zarr 2 with the dimension names xarray looks for."""
+        import zarr
+        path = os.path.join(self.folder, 'cube.zarr')
+        cube = DataCube(path, 2, 'Zarr', {'code': 'AETI', 'caption': 'Evapotranspiration', 'unit': 'mm/day'})
+        cube.add(1, self.src, datetime.datetime(2009, 1, 11))
+        cube.add(0, self.src, datetime.datetime(2009, 1, 1))
+        cube.close()
+        group = zarr.open_group(path, mode = 'r')
+        self.assertTrue(os.path.isfile(os.path.join(path, '.zgroup')))
+        self.assertEqual(group['AETI'].attrs['_ARRAY_DIMENSIONS'], ['time', 'y', 'x'])
+        self.assertEqual(group['time'].attrs['_ARRAY_DIMENSIONS'], ['time'])
+        self.assertEqual(group['AETI'].attrs['units'], 'mm/day')
+        self.assertEqual(group['AETI'].shape, (2, 50, 37))
+        np.testing.assert_array_equal(group['time'][:], [14245, 14255])
+        np.testing.assert_array_equal(group['AETI'][1], read_physical(self.src))
+
+    def test_process_raster(self):
+        """Test the two step path clips, reports its states and removes the download."""
+        cutline = os.path.join(self.folder, 'cutline.geojson')
+        make_cutline(cutline)
+        corrected = os.path.join(self.folder, 'corrected.tif')
+        expected = os.path.join(self.folder, 'expected.tif')
+        correct_raster(self.src, corrected, 0.1)
+        clip_raster(corrected, expected, cutline)
+
+        outfilename, states, checksum = process_raster(self.src, self.dst, 0.1, cutline, fused = False,
+                                                       temp_folder = self.folder)
+        self.assertEqual(outfilename, self.dst)
+        self.assertEqual(states, ['corrected', 'clipped'])
+        self.assertEqual(checksum, file_checksum(self.dst))
+        self.assertFalse(os.path.isfile(self.src))
+        np.testing.assert_array_equal(read_raster(self.dst)[0], read_raster(expected)[0])
+
+    def test_clip_prepared(self):
+        """Test the cached mask clip keeps the source pixels inside the cutline."""
+        cutline = os.path.join(self.folder, 'cutline.geojson')
+        make_cutline(cutline)
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+        prepared = prepare_cutline(cutline, os.path.join(self.folder, 'prepared.geojson'), srs.ExportToWkt())
+        self.assertTrue(clip_prepared(self.src, self.dst, prepared, 0.1))
+
+        result, ndv = read_raster(self.dst)
+        GeoT = gdal.Open(self.dst).GetGeoTransform()
+        xoff = int(round((GeoT[0] - 30.0) / 0.01))
+        yoff = int(round((10.0 - GeoT[3]) / 0.01))
+        self.assertAlmostEqual(GeoT[0], 30.0 + xoff * 0.01)
+        rows, cols = result.shape
+        source = self.array[yoff:yoff + rows, xoff:xoff + cols].astype(np.float32) * np.float32(0.1)
+        inside = (result != ndv)
+        self.assertTrue(inside.any())
+        np.testing.assert_allclose(result[inside], source[inside], rtol = 1e-6)
+
+        clipped = os.path.join(self.folder, 'clipped.tif')
+        outfilename, states, checksum = process_raster(self.src, clipped, 0.1, prepared, prepared = True)
+        np.testing.assert_array_equal(read_raster(clipped)[0], result)
+
+        #with native_dtype the integer values are kept and the correction becomes the scale,
+        #process_raster removed the download so it is written again
+        make_raster(self.src, self.array, -9999)
+        native = os.path.join(self.folder, 'native.tif')
+        self.assertTrue(clip_prepared(self.src, native, prepared, 0.1, profile = output_profile(native_dtype = True)))
+        dataset = gdal.Open(native)
+        band = dataset.GetRasterBand(1)
+        self.assertEqual(band.DataType, gdal.GDT_Int16)
+        self.assertAlmostEqual(band.GetScale(), 0.1)
+        self.assertEqual(band.GetNoDataValue(), -9999)
+        values = band.ReadAsArray()
+        dataset = None
+        np.testing.assert_array_equal(values == -9999, result == ndv)
+        np.testing.assert_array_equal(values[inside], self.array[yoff:yoff + rows, xoff:xoff + cols][inside])
+
+    def test_clip_prepared_matches_warp(self):
+        """Test the cached mask clip gives the extent, edge pixels and values of clip_raster."""
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+        corrected = os.path.join(self.folder, 'corrected.tif')
+        correct_raster(self.src, corrected, 0.1)
+        #the polygon of make_cutline has its corners on pixel corners, this one has none
+        polygons = {'on_grid': None,
+                    'off_grid': '[[30.053, 9.612], [30.287, 9.641], [30.214, 9.943], [30.071, 9.896], [30.053, 9.612]]'}
+        for name, coordinates in polygons.items():
+            cutline = os.path.join(self.folder, name + '.geojson')
+            make_cutline(cutline)
+            if coordinates != None:
+                with open(cutline, 'w') as g:
+                    g.write('{"type": "FeatureCollection", "features": [{"type": "Feature", "properties": {}, '
+                            '"geometry": {"type": "Polygon", "coordinates": [' + coordinates + ']}}]}')
+            prepared = prepare_cutline(cutline, os.path.join(self.folder, name + '_prepared.geojson'), srs.ExportToWkt())
+            warped = os.path.join(self.folder, name + '_warped.tif')
+            masked = os.path.join(self.folder, name + '_masked.tif')
+            clip_raster(corrected, warped, prepared)
+            self.assertTrue(clip_prepared(self.src, masked, prepared, 0.1))
+
+            expected, expected_ndv = read_raster(warped)
+            result, ndv = read_raster(masked)
+            self.assertEqual(result.shape, expected.shape, name)
+            for a, b in zip(gdal.Open(masked).GetGeoTransform(), gdal.Open(warped).GetGeoTransform()):
+                self.assertAlmostEqual(a, b, places = 9)
+            np.testing.assert_array_equal(result == ndv, expected == expected_ndv, name)
+            np.testing.assert_allclose(result, expected, rtol = 1e-6)
+
+    def test_run_manifest(self):
+        """Test changes are saved at most every save_interval seconds and by flush."""
+        clock = mock.Mock()
+        clock.time.return_value = 0.0
+        with mock.patch('FAO_Downloader_raster.time', clock):
+            manifest = RunManifest(self.folder, save_interval = 10)
+            manifest.update('L1_AETI_D', '0901', state = 'submitted', job_url = 'https://jobs/1')
+            self.assertFalse(os.path.isfile(manifest.path))
+            clock.time.return_value = 10.0
+            manifest.update('L1_AETI_D', '0901', state = 'downloaded')
+            self.assertEqual(RunManifest(self.folder).get('L1_AETI_D', '0901'),
+                             {'state': 'downloaded', 'job_url': 'https://jobs/1'})
+            manifest.update('L1_AETI_D', '0902', state = 'submitted')
+            self.assertEqual(RunManifest(self.folder).get('L1_AETI_D', '0902'), {})
+            manifest.flush()
+        #a new instance reads back what the first one wrote
+        resumed = RunManifest(self.folder)
+        self.assertEqual(resumed.get('L1_AETI_D', '0902'), {'state': 'submitted'})
+        self.assertEqual(resumed.data, manifest.data)
+        self.assertFalse(os.path.isfile(manifest.path + '.tmp'))
+
+    def test_run_manifest_is_done(self):
+        """Test a raster only counts as done while its file is there with the checksum it was saved with."""
+        manifest = RunManifest(self.folder)
+        self.assertFalse(manifest.is_done('L1_AETI_D', 'raw_test', self.folder))
+        manifest.update('L1_AETI_D', 'raw_test', state = 'done', file = 'raw_test.tif', checksum = file_checksum(self.src))
+        manifest.update('L1_AETI_D', 'test', state = 'done', file = 'test.tif', checksum = file_checksum(self.src))
+        self.assertTrue(manifest.is_done('L1_AETI_D', 'raw_test', self.folder))
+        self.assertFalse(manifest.is_done('L1_AETI_D', 'test', self.folder))
+        with open(self.src, 'ab') as g:
+            g.write(b'0')
+        self.assertFalse(manifest.is_done('L1_AETI_D', 'raw_test', self.folder))
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(FAODownloaderRasterTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)